@@ -0,0 +1,220 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import calendar
+import collections
+import errno
+import functools
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+CACHE_DIR = os.path.expanduser('~/.cache/cloudenvy')
+
+CachedResource = collections.namedtuple('CachedResource', ['id', 'name'])
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def cache_dir(cloud_name):
+    return os.path.join(CACHE_DIR, cloud_name or 'default')
+
+
+def endpoint_key(endpoint):
+    return hashlib.sha1(endpoint or '').hexdigest()[:12]
+
+
+class JsonFile(object):
+    """A small JSON document on disk that is always rewritten atomically.
+
+    Readers never see a partially written file, and concurrent writers in
+    this process are serialized, even through different JsonFile objects
+    for the same path. Writers in different processes may race, in which
+    case the last one wins.
+    """
+
+    def __init__(self, path, mode=0600):
+        self.path = path
+        self.mode = mode
+        with _locks_lock:
+            self._lock = _locks.setdefault(path, threading.RLock())
+
+    def load(self):
+        try:
+            with open(self.path) as fap:
+                data = json.load(fap)
+        except (IOError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def save(self, data):
+        dirname = os.path.dirname(self.path)
+        try:
+            os.makedirs(dirname, 0700)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+            try:
+                os.chmod(tmp_path, self.mode)
+                with os.fdopen(fd, 'w') as fap:
+                    json.dump(data, fap)
+                os.rename(tmp_path, self.path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+    def update(self, func):
+        """Apply func to the freshest copy of the document and save it."""
+        with self._lock:
+            data = self.load()
+            func(data)
+            self.save(data)
+            return data
+
+    def remove(self):
+        with self._lock:
+            try:
+                os.unlink(self.path)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+
+
+class Catalog(object):
+    """Cache of rarely-changing cloud resources (images, flavors, ...).
+
+    Entries are stored per cloud and endpoint under ~/.cache/cloudenvy and
+    expire after ttl seconds. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, cloud_name, endpoint, ttl):
+        self.ttl = ttl
+        filename = 'catalog-%s.json' % endpoint_key(endpoint)
+        self.store = JsonFile(os.path.join(cache_dir(cloud_name), filename))
+        self._data = None
+
+    def _entries(self):
+        if self._data is None:
+            self._data = self.store.load()
+        return self._data
+
+    def get(self, kind, key):
+        if not self.ttl:
+            return None
+        entry = self._entries().get(kind, {}).get(key)
+        if not entry or entry['time'] + self.ttl < time.time():
+            return None
+        return entry['value']
+
+    def set(self, kind, key, value):
+        if not self.ttl:
+            return
+
+        def _set(data):
+            data.setdefault(kind, {})[key] = {'time': time.time(),
+                                              'value': value}
+        try:
+            self._data = self.store.update(_set)
+        except (IOError, OSError) as exc:
+            logging.debug('Unable to write catalog cache: %s', exc)
+
+    def clear(self):
+        logging.debug('Clearing catalog cache %s', self.store.path)
+        self.store.remove()
+        self._data = {}
+
+
+class TokenCache(object):
+    """Authentication tokens and service endpoints for one cloud account.
+
+    The token is a credential, so the file is only readable by its owner.
+    Tokens are treated as expired refresh_margin seconds early so that a
+    command never starts with a token that dies halfway through.
+    """
+
+    DEFAULT_LIFETIME = 3600
+
+    def __init__(self, cloud_name, auth_url, user, tenant_name, region_name,
+                 refresh_margin=300):
+        key = endpoint_key('|'.join([auth_url or '', user or '',
+                                     tenant_name or '', region_name or '']))
+        self.store = JsonFile(os.path.join(cache_dir(cloud_name),
+                                           'token-%s.json' % key), mode=0600)
+        self.refresh_margin = refresh_margin
+
+    def get(self):
+        token = self.store.load()
+        if not token or token['expires'] - self.refresh_margin < time.time():
+            return None
+        return token
+
+    def set(self, token, endpoint, expires=None):
+        expires = _parse_time(expires) or time.time() + self.DEFAULT_LIFETIME
+        data = {'token': token, 'endpoint': endpoint, 'expires': expires}
+        try:
+            self.store.save(data)
+        except (IOError, OSError) as exc:
+            logging.debug('Unable to write token cache: %s', exc)
+
+    def clear(self):
+        self.store.remove()
+
+
+def _parse_time(timestamp):
+    """Parse a Keystone (ISO 8601, UTC) timestamp into seconds since epoch."""
+    try:
+        return calendar.timegm(time.strptime(timestamp[:19],
+                                             '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+
+def clear(cloud_name):
+    """Remove the catalog caches of every endpoint of a cloud."""
+    paths = glob.glob(os.path.join(cache_dir(cloud_name), 'catalog-*.json'))
+    for path in paths:
+        JsonFile(path).remove()
+    return len(paths)
+
+
+def _dump(resource):
+    if isinstance(resource, basestring):
+        return resource
+    return {'id': resource.id, 'name': getattr(resource, 'name', None)}
+
+
+def _restore(value):
+    if isinstance(value, dict):
+        return CachedResource(**value)
+    return value
+
+
+def cached(kind):
+    """decorator for CloudAPI lookups whose results rarely change.
+
+    The wrapped method must take a single search string. Hits are returned
+    as CachedResource tuples (or plain strings) straight from the catalog
+    without calling the cloud; misses are never cached.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(self, search_str):
+            value = self.catalog.get(kind, search_str)
+            if value is not None:
+                logging.debug('Using cached %s %s', kind, search_str)
+                return _restore(value)
+
+            resource = func(self, search_str)
+            if resource:
+                self.catalog.set(kind, search_str, _dump(resource))
+            return resource
+        return wrapped
+    return decorator
@@ -0,0 +1,183 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import hashlib
+import logging
+import os
+import threading
+
+from cloudenvy import exceptions
+import cloudenvy.cache
+import cloudenvy.fleet
+import cloudenvy.ssh
+import cloudenvy.transfer
+
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Files at least this large are uploaded in chunks.
+DEFAULT_THRESHOLD = 64 * 1024 * 1024
+
+DEFAULT_PARALLELISM = 4
+
+RETRIES = 3
+
+JOURNAL_DIR = os.path.join(cloudenvy.cache.CACHE_DIR, 'uploads')
+
+PART_SUFFIX = '.cloudenvy-part'
+
+
+def sftp_path(remote_path):
+    """SFTP paths are relative to the home directory and don't expand ~."""
+    if remote_path == '~':
+        return '.'
+    if remote_path.startswith('~/'):
+        return remote_path[2:]
+    return remote_path
+
+
+def _chunk_hash(path, index, chunk_size):
+    with open(path, 'rb') as fap:
+        fap.seek(index * chunk_size)
+        return hashlib.sha256(fap.read(chunk_size)).hexdigest()
+
+
+class Upload(object):
+    """A resumable upload of one large file to an Envy.
+
+    The file is split into chunk_size ranges that are written into a
+    partial file next to the target, each over its own SFTP channel on the
+    shared SSH transport, and verified against a sha256 computed on the
+    Envy. Finished chunks are recorded in a journal under
+    ~/.cache/cloudenvy/uploads, so an interrupted upload picks up where it
+    left off as long as the local file hasn't changed. The partial file is
+    moved into place once every chunk is in.
+    """
+
+    def __init__(self, connection, local_path, remote_path,
+                 chunk_size=CHUNK_SIZE, parallelism=DEFAULT_PARALLELISM):
+        self.connection = connection
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.part_path = remote_path + PART_SUFFIX
+        self.chunk_size = chunk_size
+        self.parallelism = parallelism
+
+        stat = os.stat(local_path)
+        self.size = stat.st_size
+        self.mode = stat.st_mode & 07777
+        self.key = {'local_path': os.path.abspath(local_path),
+                    'remote_path': remote_path,
+                    'host': connection.host_string,
+                    'size': self.size, 'mtime': int(stat.st_mtime),
+                    'chunk_size': chunk_size}
+        name = hashlib.sha1('|'.join([self.key['host'], remote_path,
+                                      self.key['local_path']])).hexdigest()
+        self.journal = cloudenvy.cache.JsonFile(
+            os.path.join(JOURNAL_DIR, '%s.json' % name))
+        self._local = threading.local()
+        self._clients = []
+
+    @property
+    def chunks(self):
+        return max((self.size + self.chunk_size - 1) // self.chunk_size, 1)
+
+    def _sftp(self):
+        """One SFTP channel per worker thread."""
+        if getattr(self._local, 'sftp', None) is None:
+            self._local.sftp = self.connection.connect().open_sftp()
+            self._clients.append(self._local.sftp)
+        return self._local.sftp
+
+    def _resume(self):
+        """Return the chunks already on the Envy, preparing the part file."""
+        journal = self.journal.load()
+        sftp = self._sftp()
+        part = sftp_path(self.part_path)
+        if journal.get('key') == self.key:
+            try:
+                if sftp.stat(part).st_size == self.size:
+                    return set(journal.get('done', []))
+            except IOError:
+                pass
+            logging.info("Partial upload of '%s' is gone; starting over.",
+                         self.remote_path)
+
+        with sftp.open(part, 'w') as fap:
+            fap.truncate(self.size)
+        self.journal.save({'key': self.key, 'done': []})
+        return set()
+
+    def _send(self, index):
+        offset = index * self.chunk_size
+        expected = _chunk_hash(self.local_path, index, self.chunk_size)
+
+        for attempt in xrange(RETRIES):
+            with open(self.local_path, 'rb') as local:
+                local.seek(offset)
+                remote = self._sftp().open(sftp_path(self.part_path), 'r+')
+                try:
+                    remote.set_pipelined(True)
+                    remote.seek(offset)
+                    remaining = min(self.chunk_size, self.size - offset)
+                    while remaining > 0:
+                        block = local.read(min(cloudenvy.transfer.BLOCKSIZE,
+                                               remaining))
+                        remote.write(block)
+                        remaining -= len(block)
+                finally:
+                    remote.close()
+
+            status, stdout, stderr = self.connection.exec_command(
+                'dd if=%s bs=%d skip=%d count=1 2>/dev/null | sha256sum'
+                % (cloudenvy.ssh.quote_path(self.part_path),
+                   self.chunk_size, index))
+            if stdout.split()[:1] == [expected]:
+                self.journal.update(
+                    lambda data: data.setdefault('done', []).append(index))
+                return
+            logging.warning('Chunk %d of %s failed verification '
+                            '(attempt %d of %d).', index, self.local_path,
+                            attempt + 1, RETRIES)
+
+        raise exceptions.TransferError('Chunk %d of %s could not be uploaded.'
+                                       % (index, self.local_path))
+
+    def run(self):
+        stats = cloudenvy.transfer.Stats()
+        done = self._resume()
+        pending = [index for index in xrange(self.chunks)
+                   if index not in done]
+        logging.info("Uploading '%s' to '%s' in %d chunk(s) (%d done "
+                     "earlier).", self.local_path, self.remote_path,
+                     self.chunks, len(done))
+
+        try:
+            results = cloudenvy.fleet.run_concurrently(
+                self._send, pending, self.parallelism)
+        finally:
+            for client in self._clients:
+                client.close()
+        errors = [result for result in results if result.error]
+        if errors:
+            raise exceptions.TransferError(
+                'Upload of %s was interrupted after %d of %d chunk(s); run '
+                'it again to resume: %s' % (
+                    self.local_path, self.chunks - len(errors), self.chunks,
+                    errors[0].error))
+
+        status, stdout, stderr = self.connection.exec_command(
+            'chmod %o %s && mv -f %s %s' % (
+                self.mode, cloudenvy.ssh.quote_path(self.part_path),
+                cloudenvy.ssh.quote_path(self.part_path),
+                cloudenvy.ssh.quote_path(self.remote_path)))
+        if status:
+            raise exceptions.TransferError(
+                'Unable to move %s into place: %s'
+                % (self.remote_path, stderr.strip()))
+        self.journal.remove()
+
+        stats.files = 1
+        stats.bytes = sum(min(self.chunk_size,
+                              self.size - index * self.chunk_size)
+                          for index in pending)
+        stats.log()
+        return stats
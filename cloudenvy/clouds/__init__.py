@@ -1,9 +1,34 @@
-import pkg_resources
+import importlib
+
+#NOTE: Scanning entry points means importing pkg_resources, which indexes
+# every installed distribution and dominates the startup time of short
+# commands. The backends shipped with cloudenvy are therefore resolved from
+# this table, and entry points are only scanned for other names. Keep it in
+# sync with the cloudenvy_cloud_apis entry points in setup.py.
+BUILTIN_APIS = {
+    'ec2': 'cloudenvy.clouds.ec2:CloudAPI',
+    'openstack': 'cloudenvy.clouds.openstack:CloudAPI',
+}
+
+_api_classes = {}
+
 
 def _get_cloud_api(name):
+    import pkg_resources
     for ep in pkg_resources.iter_entry_points(group='cloudenvy_cloud_apis', name=name):
         yield ep.load()
 
+
+def _load(path):
+    module_name, class_name = path.split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
 def get_api_cls(cloud_type):
-    apis = list(_get_cloud_api(cloud_type))
-    return apis[0]
+    if cloud_type not in _api_classes:
+        if cloud_type in BUILTIN_APIS:
+            _api_classes[cloud_type] = _load(BUILTIN_APIS[cloud_type])
+        else:
+            apis = list(_get_cloud_api(cloud_type))
+            _api_classes[cloud_type] = apis[0]
+    return _api_classes[cloud_type]
@@ -1,17 +1,30 @@
 import collections
+import threading
 import time
 import urlparse
 
 import boto.ec2.connection
 
+import cloudenvy.cache
+import cloudenvy.waiter
 
-Server = collections.namedtuple('Server', ['id', 'name'])
+
+Server = collections.namedtuple('Server', ['id', 'name', 'state',
+                                           'ip_address'])
 Image = collections.namedtuple('Image', ['id', 'name'])
 
+# Images created by snapshot(), with status one of 'ready', 'pending' or
+# 'failed'.
+Snapshot = collections.namedtuple('Snapshot', ['id', 'name', 'metadata',
+                                               'status'])
+
+SNAPSHOT_STATUS = {'available': 'ready', 'pending': 'pending'}
+
 
 class CloudAPI(object):
     def __init__(self, config):
         self._client = None
+        self._lock = threading.Lock()
         self.config = config
 
         ec2_endpoint = self.config.user_config['cloud'].get('ec2_endpoint', None)
@@ -20,40 +33,59 @@ class CloudAPI(object):
         self.secret_key = self.config.user_config['cloud'].get('ec2_secret_key', None)
         self.region_name = self.config.user_config['cloud'].get('ec2_region_name', 'RegionOne')
 
+        self.catalog = cloudenvy.cache.Catalog(config.cloud_name,
+                                               ec2_endpoint,
+                                               config.catalog_ttl)
+
     @property
     def client(self):
-        if not self._client:
-            region = boto.ec2.regioninfo.RegionInfo(
-                    name=self.region_name, endpoint=self.endpoint.hostname)
-
-            kwargs = {
-                'aws_access_key_id': self.access_key,
-                'aws_secret_access_key': self.secret_key,
-                'is_secure': self.endpoint.scheme == 'https',
-                'host': self.endpoint.hostname,
-                #'port': self.endpoint.port,
-                'path': self.endpoint.path,
-                'validate_certs': False,
-                'region': region,
-            }
-            self._client = boto.ec2.connection.EC2Connection(**kwargs)
+        with self._lock:
+            if not self._client:
+                self._client = self._build_client()
         return self._client
 
+    def _build_client(self):
+        region = boto.ec2.regioninfo.RegionInfo(
+                name=self.region_name, endpoint=self.endpoint.hostname)
+
+        kwargs = {
+            'aws_access_key_id': self.access_key,
+            'aws_secret_access_key': self.secret_key,
+            'is_secure': self.endpoint.scheme == 'https',
+            'host': self.endpoint.hostname,
+            #'port': self.endpoint.port,
+            'path': self.endpoint.path,
+            'validate_certs': False,
+            'region': region,
+        }
+        return boto.ec2.connection.EC2Connection(**kwargs)
+
     @staticmethod
     def _instance_to_dict(instance):
-        return Server(id=instance.id, name=instance.tags.get('Name', ''))
+        return Server(id=instance.id, name=instance.tags.get('Name', ''),
+                      state=instance.state, ip_address=instance.ip_address)
 
     @staticmethod
     def _image_to_dict(image):
         return Image(id=image.id, name=image.id)
 
-    def is_server_active(self, server_id):
-        inst = self._get_server(server_id)
-        return inst.state == 'running'
+    @staticmethod
+    def is_server_active(server):
+        return server is not None and server.state == 'running'
 
-    def is_network_active(self, server_id):
-        inst = self._get_server(server_id)
-        return bool(inst.ip_address)
+    @staticmethod
+    def is_server_failed(server):
+        return server is not None and server.state in ('shutting-down',
+                                                       'terminated')
+
+    @staticmethod
+    def is_server_deleted(server):
+        return server is None or server.state in ('shutting-down',
+                                                  'terminated')
+
+    @staticmethod
+    def is_network_active(server):
+        return server is not None and bool(server.ip_address)
 
     def list_servers(self):
         instances = self.client.get_only_instances(filters={'instance-state-name': 'running'})
@@ -65,14 +97,45 @@ class CloudAPI(object):
             if server.name == name:
                 return server
 
+    def rename_server(self, server, name):
+        self.client.create_tags([server.id], {'Name': name})
+
+    @staticmethod
+    def _is_not_found(exc):
+        return exc.error_code == 'InvalidInstanceID.NotFound'
+
     def _get_server(self, server_id):
-        instances = self.client.get_only_instances([server_id])
+        try:
+            instances = self.client.get_only_instances([server_id])
+        except boto.exception.EC2ResponseError as exc:
+            if not self._is_not_found(exc):
+                raise
+            return None
         return instances[0] if instances else None
 
     def get_server(self, server_id):
         inst = self._get_server(server_id)
         return self._instance_to_dict(inst) if inst else None
 
+    def get_servers(self, server_ids):
+        server_ids = list(server_ids)
+        try:
+            instances = self.client.get_only_instances(server_ids)
+        except boto.exception.EC2ResponseError as exc:
+            # Anything but an unknown id (e.g. throttling) must not pass for
+            # the servers being gone.
+            if not self._is_not_found(exc):
+                raise
+            #NOTE: freshly launched instances may not be visible yet, and a
+            # single unknown id fails the whole call, so look the servers
+            # up one by one to tell which are missing.
+            instances = [instance for instance in
+                         [self._get_server(server_id)
+                          for server_id in server_ids]
+                         if instance is not None]
+        return dict((inst.id, self._instance_to_dict(inst))
+                    for inst in instances)
+
     def create_server(self, *args, **kwargs):
         name = kwargs.pop('name')
         image = kwargs.pop('image')
@@ -80,26 +143,28 @@ class CloudAPI(object):
         meta = kwargs.pop('meta', {})
         security_groups = kwargs.pop('security_groups')
         key_name = kwargs.pop('key_name')
+        userdata = kwargs.pop('userdata', None)
 
         _kwargs = {
             'key_name': key_name,
             'security_groups': security_groups,
             'instance_type': flavor,
+            'user_data': userdata,
         }
 
-        image = self._find_image(image.id)
-        reservation = image.run(**_kwargs)
-        instance = reservation.instances[0]
-        status = instance.update()
-
-        for i in xrange(60):
-            status = instance.update()
-            if status == 'running':
-                break
-            time.sleep(1)
-        else:
+        try:
+            reservation = self.client.run_instances(image.id, **_kwargs)
+        except boto.exception.EC2ResponseError as exc:
+            if 'NotFound' in (exc.error_code or ''):
+                self.catalog.clear()
             raise
+        instance = reservation.instances[0]
 
+        # Tagging fails until the instance is visible to the API, but there
+        # is no need to wait for it to be running; the caller does that.
+        waiter = cloudenvy.waiter.Waiter(self)
+        waiter.wait([instance.id], lambda server: server is not None,
+                    'Instance %s never became visible' % instance.id)
         instance.add_tag('Name', name)
 
         return self._instance_to_dict(instance)
@@ -108,20 +173,60 @@ class CloudAPI(object):
         #NOTE(bcwaldon): We depend on EC2 to do this for us today
         return
 
-    def find_ip(self, server_id):
-        instance = self._get_server(server_id)
-        return instance.ip_address
+    def find_ip(self, server):
+        return server.ip_address
 
     def _find_image(self, image_id):
         #NOTE(bcwaldon): This only works with image ids for now
         return self.client.get_image(image_id)
 
+    @cloudenvy.cache.cached('image')
     def find_image(self, search_str):
         image = self._find_image(search_str)
         return self._image_to_dict(image)
 
-    def snapshot(self, server, name):
-        raise NotImplementedError()
+    def snapshot(self, server, name, metadata=None):
+        #NOTE: no_reboot keeps the Envy usable while the image is taken, at
+        # the price of the image being crash- rather than shutdown-consistent.
+        image_id = self.client.create_image(server.id, name, no_reboot=True)
+        if metadata:
+            self._tag(image_id, metadata)
+        return image_id
+
+    def _tag(self, resource_id, tags, timeout=60):
+        """Tag a resource, waiting for it to become visible to the API."""
+        deadline = time.time() + timeout
+        delays = cloudenvy.waiter.backoff(1.0, 10.0)
+        while True:
+            try:
+                return self.client.create_tags([resource_id], tags)
+            except boto.exception.EC2ResponseError as exc:
+                if 'NotFound' not in (exc.error_code or '') \
+                        or time.time() > deadline:
+                    raise
+            time.sleep(next(delays))
+
+    @staticmethod
+    def _snapshot_to_tuple(image):
+        return Snapshot(id=image.id, name=image.name,
+                        metadata=dict(image.tags),
+                        status=SNAPSHOT_STATUS.get(image.state, 'failed'))
+
+    def list_snapshots(self, key):
+        """Return the account's images that have a tag named key."""
+        images = self.client.get_all_images(owners=['self'],
+                                            filters={'tag-key': key})
+        return [self._snapshot_to_tuple(image) for image in images]
+
+    def update_snapshot(self, image_id, metadata):
+        self._tag(image_id, metadata)
+
+    def delete_snapshot(self, image_id):
+        try:
+            self.client.deregister_image(image_id, delete_snapshot=True)
+        except boto.exception.EC2ResponseError as exc:
+            if 'NotFound' not in (exc.error_code or ''):
+                raise
 
     def find_flavor(self, name):
         return name
@@ -132,6 +237,7 @@ class CloudAPI(object):
         except boto.exception.EC2ResponseError:
             return None
 
+    @cloudenvy.cache.cached('security_group')
     def find_security_group(self, name):
         sg = self._find_security_group(name)
         return name if sg else None
@@ -150,8 +256,10 @@ class CloudAPI(object):
         except boto.exception.EC2ResponseError:
             pass
 
+    @cloudenvy.cache.cached('keypair')
     def find_keypair(self, name):
-        return self.client.get_key_pair(name)
+        keypair = self.client.get_key_pair(name)
+        return keypair.name if keypair else None
 
     def create_keypair(self, name, key_data):
         self.client.import_key_pair(name, key_data)
@@ -1,7 +1,9 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
+import collections
 import functools
 import getpass
 import logging
+import threading
 import time
 import uuid
 
@@ -9,6 +11,23 @@ import novaclient.exceptions
 import novaclient.client
 
 from cloudenvy import exceptions
+import cloudenvy.cache
+
+
+#NOTE: Envys booted together (e.g. a fleet) set up their networks from
+# several threads at once. Picking a free floating IP and assigning it has
+# to happen as one step, or two servers can pick the same address and the
+# first would lose it to the second.
+_floating_ip_lock = threading.Lock()
+
+# Images created by snapshot(), with status one of 'ready', 'pending' or
+# 'failed'.
+Snapshot = collections.namedtuple('Snapshot', ['id', 'name', 'metadata',
+                                               'status'])
+
+SNAPSHOT_STATUS = {'ACTIVE': 'ready', 'SAVING': 'pending',
+                   'QUEUED': 'pending'}
+
 
 def not_found(func):
     @functools.wraps(func)
@@ -65,6 +84,10 @@ def retry_on_overlimit(func):
 class CloudAPI(object):
     def __init__(self, config):
         self._client = None
+        #NOTE: one CloudAPI is shared by Envys used from several threads, so
+        # building the client, prompting for the password and
+        # authenticating happen under this lock, once.
+        self._lock = threading.RLock()
         self.config = config
 
         #NOTE(bcwaldon): This was just dumped here to make room for EC2.
@@ -75,48 +98,137 @@ class CloudAPI(object):
             except KeyError:
                 raise SystemExit("Ensure '%s' is set in user config" % item)
 
-        try:
-            password = config.user_config['cloud']['os_password']
-        except KeyError:
-            username = config.user_config['cloud']['os_username']
-            prompt = "Password for account '%s': " % username
-            password = getpass.getpass(prompt)
-            config.user_config['cloud']['os_password'] = password
-
         # OpenStack Auth Items
         self.user = self.config.user_config['cloud'].get('os_username', None)
-        self.password = self.config.user_config['cloud'].get('os_password', None)
         self.tenant_name = self.config.user_config['cloud'].get('os_tenant_name',
                                                          None)
         self.auth_url = self.config.user_config['cloud'].get('os_auth_url', None)
         self.region_name = self.config.user_config['cloud'].get('os_region_name',
                                                          None)
 
+        self.catalog = cloudenvy.cache.Catalog(config.cloud_name,
+                                               self.auth_url,
+                                               config.catalog_ttl)
+        self.tokens = cloudenvy.cache.TokenCache(config.cloud_name,
+                                                 self.auth_url, self.user,
+                                                 self.tenant_name,
+                                                 self.region_name)
+
+    @property
+    def password(self):
+        """The account password, prompted for the first time it is needed.
+
+        A valid cached token means the password is never needed at all.
+        """
+        with self._lock:
+            try:
+                return self.config.user_config['cloud']['os_password']
+            except KeyError:
+                prompt = "Password for account '%s': " % self.user
+                password = getpass.getpass(prompt)
+                self.config.user_config['cloud']['os_password'] = password
+                return password
+
     @property
     def client(self):
-        if not self._client:
-            self._client = novaclient.client.Client(
-                '2',
-                self.user,
-                self.password,
-                self.tenant_name,
-                self.auth_url,
-                no_cache=True,
-                region_name=self.region_name)
+        with self._lock:
+            if not self._client:
+                self._client = self._build_client()
         return self._client
 
-    def is_server_active(self, server_id):
-        server = self.get_server(server_id)
-        return server.status == 'ACTIVE'
-
-    def is_network_active(self, server_id):
-        server = self.get_server(server_id)
-        return len(server.networks) > 0
+    def _build_client(self):
+        kwargs = {}
+        token = self.tokens.get()
+        if token:
+            logging.debug('Using cached token for %s', self.auth_url)
+            kwargs = {'auth_token': token['token'],
+                      'bypass_url': token['endpoint']}
+            password = self.config.user_config['cloud'].get('os_password')
+        else:
+            password = self.password
+
+        client = novaclient.client.Client(
+            '2',
+            self.user,
+            password,
+            self.tenant_name,
+            self.auth_url,
+            no_cache=True,
+            region_name=self.region_name,
+            connection_pool=True,
+            **kwargs)
+
+        #NOTE: novaclient authenticates lazily before the first request
+        # and again whenever a request comes back 401, both through
+        # authenticate(). Hooking it lets us drop the rejected token and
+        # remember the new one without touching every API call.
+        http_client = client.client
+        authenticate = http_client.authenticate
+
+        def _authenticate():
+            with self._lock:
+                self.tokens.clear()
+                if http_client.password is None:
+                    http_client.password = self.password
+                authenticate()
+                self._remember_token(http_client)
+
+        http_client.authenticate = _authenticate
+        return client
+
+    def _remember_token(self, http_client):
+        try:
+            access = http_client.service_catalog.catalog['access']
+            expires = access['token']['expires']
+        except (AttributeError, KeyError, TypeError):
+            expires = None
+        self.tokens.set(http_client.auth_token, http_client.management_url,
+                        expires)
+
+    @staticmethod
+    def is_server_active(server):
+        return server is not None and server.status == 'ACTIVE'
+
+    @staticmethod
+    def is_server_failed(server):
+        return server is not None and server.status == 'ERROR'
+
+    @staticmethod
+    def is_server_deleted(server):
+        return server is None or server.status == 'DELETED'
+
+    @staticmethod
+    def _addresses(server):
+        return [address
+                for addresses in (getattr(server, 'addresses', None)
+                                  or {}).values()
+                for address in addresses]
+
+    @classmethod
+    def is_network_active(cls, server):
+        """Whether the server has its floating IP, as far as we can tell.
+
+        A fixed address alone shows up before the floating IP does. Without
+        the extended IPs extension the two can't be told apart, so any
+        address has to do.
+        """
+        if server is None or not server.networks:
+            return False
+        addresses = cls._addresses(server)
+        if any('OS-EXT-IPS:type' in address for address in addresses):
+            return any(address.get('OS-EXT-IPS:type') == 'floating'
+                       for address in addresses)
+        return True
 
     @bad_request
     def list_servers(self):
         return self.client.servers.list()
 
+    @bad_request
+    @not_found
+    def rename_server(self, server, name):
+        self.client.servers.update(server, name=name)
+
     @bad_request
     @not_found
     def find_server(self, name):
@@ -127,6 +239,16 @@ class CloudAPI(object):
     def get_server(self, server_id):
         return self.client.servers.get(server_id)
 
+    @bad_request
+    def get_servers(self, server_ids):
+        server_ids = set(server_ids)
+        if len(server_ids) == 1:
+            server = self.get_server(server_ids.pop())
+            return {server.id: server} if server else {}
+        return dict((server.id, server)
+                    for server in self.client.servers.list()
+                    if server.id in server_ids)
+
     @retry_on_overlimit
     @bad_request
     def create_server(self, *args, **kwargs):
@@ -135,20 +257,28 @@ class CloudAPI(object):
         #https://github.com/cloudenvy/cloudenvy/issues/125 for more info.
         kwargs['meta']['os_auth_url'] = self.auth_url
 
-        return self.client.servers.create(*args, **kwargs)
+        try:
+            return self.client.servers.create(*args, **kwargs)
+        except (novaclient.exceptions.NotFound,
+                novaclient.exceptions.BadRequest):
+            # Nova answers 400 or 404 when the image, flavor, keypair or
+            # security group we passed is gone, so drop anything cached.
+            self.catalog.clear()
+            raise
 
     def setup_network(self, server_id):
         server = self.get_server(server_id)
 
-        try:
-            floating_ip = self._find_free_ip()
-        except exceptions.NoIPsAvailable:
-            logging.info('Allocating a new floating ip to project.')
-            self._allocate_floating_ip()
-            floating_ip = self._find_free_ip()
+        with _floating_ip_lock:
+            try:
+                floating_ip = self._find_free_ip()
+            except exceptions.NoIPsAvailable:
+                logging.info('Allocating a new floating ip to project.')
+                self._allocate_floating_ip()
+                floating_ip = self._find_free_ip()
 
-        logging.info('Assigning floating ip %s to server.', floating_ip)
-        self._assign_ip(server, floating_ip)
+            logging.info('Assigning floating ip %s to server.', floating_ip)
+            self._assign_ip(server, floating_ip)
 
     @bad_request
     def _find_free_ip(self):
@@ -158,8 +288,19 @@ class CloudAPI(object):
                 return fip.ip
         raise exceptions.NoIPsAvailable()
 
+    def find_ip(self, server):
+        for address in self._addresses(server):
+            if address.get('OS-EXT-IPS:type') == 'floating':
+                return address['addr']
+
+        #NOTE: Without the extended IPs extension the payload can't tell
+        # fixed and floating addresses apart, and a payload fetched just
+        # before the floating IP was attached doesn't list it yet, so ask
+        # the pool instead.
+        return self._find_server_floating_ip(server.id)
+
     @bad_request
-    def find_ip(self, server_id):
+    def _find_server_floating_ip(self, server_id):
         fips = self.client.floating_ips.list()
         for fip in fips:
             if fip.instance_id == server_id:
@@ -170,6 +311,7 @@ class CloudAPI(object):
     def _assign_ip(self, server, ip):
         server.add_floating_ip(ip)
 
+    @cloudenvy.cache.cached('image')
     @bad_request
     @not_found
     def find_image(self, search_str):
@@ -177,6 +319,10 @@ class CloudAPI(object):
             return self.client.images.find(name=search_str)
         except novaclient.exceptions.NotFound:
             pass
+        except novaclient.exceptions.NoUniqueMatch:
+            msg = ('There are more than one images named %s. Please specify '
+                   'image id in your config.')
+            raise SystemExit(msg % search_str)
 
         try:
             #NOTE(bcwaldon): We can't guarantee all images use UUID4 for their
@@ -191,14 +337,39 @@ class CloudAPI(object):
 
     @retry_on_overlimit
     @bad_request
-    def snapshot(self, server, name):
-        return self.client.servers.create_image(server, name)
+    def snapshot(self, server, name, metadata=None):
+        return self.client.servers.create_image(server, name, metadata)
+
+    @staticmethod
+    def _snapshot_to_tuple(image):
+        return Snapshot(id=image.id, name=image.name,
+                        metadata=getattr(image, 'metadata', None) or {},
+                        status=SNAPSHOT_STATUS.get(image.status, 'failed'))
+
+    @bad_request
+    def list_snapshots(self, key):
+        """Return the images whose metadata has key."""
+        return [self._snapshot_to_tuple(image)
+                for image in self.client.images.list()
+                if key in (getattr(image, 'metadata', None) or {})]
 
+    @bad_request
+    @not_found
+    def update_snapshot(self, image_id, metadata):
+        self.client.images.set_meta(image_id, metadata)
+
+    @bad_request
+    @not_found
+    def delete_snapshot(self, image_id):
+        self.client.images.delete(image_id)
+
+    @cloudenvy.cache.cached('flavor')
     @bad_request
     @not_found
     def find_flavor(self, name):
         return self.client.flavors.find(name=name)
 
+    @cloudenvy.cache.cached('security_group')
     @bad_request
     @not_found
     def find_security_group(self, name):
@@ -208,7 +379,10 @@ class CloudAPI(object):
     @bad_request
     @not_found
     def create_security_group(self, name):
-        return self.client.security_groups.create(name, name)
+        try:
+            return self.client.security_groups.create(name, name)
+        except novaclient.exceptions.BadRequest:
+            logging.error('Security Group "%s" already exists.' % name)
 
     @retry_on_overlimit
     def create_security_group_rule(self, security_group, rule):
@@ -218,12 +392,16 @@ class CloudAPI(object):
         except novaclient.exceptions.BadRequest:
             logging.info('Security Group Rule "%s" already exists.' %
                          str(rule))
+        except novaclient.exceptions.NotFound:
+            self.catalog.clear()
+            raise
 
     @retry_on_overlimit
     @bad_request
     def _allocate_floating_ip(self):
         return self.client.floating_ips.create()
 
+    @cloudenvy.cache.cached('keypair')
     @bad_request
     @not_found
     def find_keypair(self, name):
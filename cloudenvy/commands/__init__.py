@@ -0,0 +1,73 @@
+import argparse
+import importlib
+import string
+
+
+#NOTE: Importing a command module pulls in its dependencies (fabric,
+# paramiko, the cloud clients, ...), so the command line is built from this
+# table and only the module of the command being run is imported. Every
+# module in this package must be listed here, together with the names of
+# the subcommands it registers and their one-line help.
+COMMANDS = {
+    'cache': {'cache': 'Manage the local cache of cloud resources.'},
+    'destroy': {'destroy': 'Destroy an Envy.',
+                'down': 'Alias for destroy command.'},
+    'dotfiles': {'dotfiles': 'Upload dotfiles from your local machine to an '
+                             'Envy.'},
+    'files': {'files': 'Upload arbitrary files from your local machine to '
+                       'an Envy.'},
+    'init': {'init': 'Initialize a new cloudenvy project.'},
+    'ip': {'ip': 'Print IPv4 address of Envy.'},
+    'list': {'list': 'List all Envys in your current project.'},
+    'pool': {'pool': 'Manage the pool of standby Envys.'},
+    'provision': {'provision': 'Upload and execute script(s) in your Envy.'},
+    'run': {'run': 'Execute a command in your Envy.'},
+    'scp': {'scp': 'Copy file(s) into your Envy.'},
+    'snapshot': {'snapshot': 'Snapshot your Envy.'},
+    'ssh': {'ssh': 'SSH into your Envy.'},
+    'up': {'up': 'Create and optionally provision an Envy.'},
+}
+
+
+def module_for(subcommand):
+    """Return the name of the module that registers a subcommand."""
+    for module, subcommands in COMMANDS.iteritems():
+        if subcommand in subcommands:
+            return module
+
+
+class Registry(dict):
+    """Command instances, keyed by module name, imported on first use.
+
+    Commands loaded with load() register their real subparsers; commands
+    that are only looked up (e.g. `up` running `files`) are built against
+    a throwaway parser.
+    """
+
+    def __init__(self, subparsers):
+        super(Registry, self).__init__()
+        self.subparsers = subparsers
+
+    def load(self, command, subparsers=None):
+        """Import a command module and instantiate its command class.
+
+        This looks for a class in the module that has the same name as
+        the module with the first character uppercased. For example, the
+        cloudenvy.commands.up module should have a class Up within it.
+        """
+        module = importlib.import_module('cloudenvy.commands.%s' % command)
+        command_class = getattr(module, string.capitalize(command))
+        self[command] = command_class(subparsers or self.subparsers, self)
+        return self[command]
+
+    def __missing__(self, command):
+        return self.load(command, argparse.ArgumentParser().add_subparsers())
+
+    def add_placeholders(self, exclude=()):
+        """Register help-only subparsers for commands that weren't loaded."""
+        for command in sorted(COMMANDS):
+            if command in exclude:
+                continue
+            for subcommand, help_str in sorted(COMMANDS[command].items()):
+                self.subparsers.add_parser(subcommand, help=help_str,
+                                           description=help_str)
@@ -0,0 +1,26 @@
+import logging
+
+import cloudenvy.cache
+import cloudenvy.core
+
+
+class Cache(cloudenvy.core.Command):
+
+    requires = cloudenvy.core.REQUIRES_CONFIG
+
+    def _build_subparser(self, subparsers):
+        help_str = 'Manage the local cache of cloud resources.'
+        subparser = subparsers.add_parser('cache', help=help_str,
+                                          description=help_str)
+        subparser.set_defaults(func=self.run)
+
+        subparser.add_argument('action', choices=['clear'],
+                               help='Drop every cached image, flavor, '
+                                    'security group and keypair lookup for '
+                                    'the current cloud.')
+        return subparser
+
+    def run(self, config, args):
+        if args.action == 'clear':
+            count = cloudenvy.cache.clear(config.cloud_name)
+            logging.info('Cleared %d catalog cache(s).', count)
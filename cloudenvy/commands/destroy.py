@@ -1,6 +1,8 @@
 import logging
 
+from cloudenvy import exceptions
 import cloudenvy.core
+import cloudenvy.fleet
 
 
 class Destroy(cloudenvy.core.Command):
@@ -9,29 +11,87 @@ class Destroy(cloudenvy.core.Command):
         help_str = 'Destroy an Envy.'
         subparser = subparsers.add_parser('destroy', help=help_str,
                                           description=help_str)
-        subparser.set_defaults(func=self.run)
-        subparser.add_argument('-n', '--name', action='store', default='',
-                               help='Specify custom name for an Envy.')
+        self._add_arguments(subparser)
 
         #TODO(bcwaldon): design a better method for command aliases
         help_str = 'Alias for destroy command.'
         subparser = subparsers.add_parser('down', help=help_str,
                                           description=help_str)
+        self._add_arguments(subparser)
+
+        return subparser
+
+    def _add_arguments(self, subparser):
         subparser.set_defaults(func=self.run)
         subparser.add_argument('-n', '--name', action='store', default='',
                                help='Specify custom name for an Envy.')
-
-        return subparser
+        group = subparser.add_mutually_exclusive_group()
+        group.add_argument('--all', action='store_true',
+                           help='Destroy every Envy in your current '
+                                'project.')
+        group.add_argument('--prefix', action='store', default=None,
+                           help='Destroy every Envy in your current project '
+                                'whose name starts with PREFIX.')
+        subparser.add_argument('--parallel', type=int,
+                               default=cloudenvy.fleet.DEFAULT_PARALLELISM,
+                               metavar='N',
+                               help='Maximum number of concurrent deletions '
+                                    'with --all or --prefix.')
 
     def run(self, config, args):
+        if args.all or args.prefix is not None:
+            return self._run_bulk(config, args)
+
         envy = cloudenvy.core.Envy(config)
+        server = envy.find_server()
 
-        if envy.find_server():
+        if server:
             envy.delete_server()
             logging.info('Deletion of Envy \'%s\' was triggered.' % envy.name)
-            while envy.find_server():
-                logging.info("... still waiting")
+            envy.waiter().wait([server.id], envy.cloud_api.is_server_deleted,
+                               'Envy was not deleted in time')
             logging.info("Done!")
 
         else:
             logging.error('Could not find Envy named \'%s\'.' % envy.name)
+
+    def _run_bulk(self, config, args):
+        envy = cloudenvy.core.Envy(config)
+        servers = cloudenvy.fleet.select(envy,
+                                         None if args.all else args.prefix)
+
+        if not servers:
+            logging.error('Could not find any matching Envys.')
+            return
+
+        servers = dict((server.name, server) for server in servers)
+        for name in sorted(servers):
+            logging.info('Triggering deletion of Envy \'%s\'.', name)
+
+        def _delete(name):
+            envy.cloud_api.delete_server(servers[name])
+            envy.state.forget(name)
+
+        results = cloudenvy.fleet.run_concurrently(_delete, sorted(servers),
+                                                   args.parallel)
+
+        failed = set()
+        for result in results:
+            if result.error is not None:
+                logging.error('Could not delete Envy \'%s\': %s',
+                              result.name, result.error)
+                failed.add(result.name)
+
+        server_ids = [server.id for name, server in servers.iteritems()
+                      if name not in failed]
+        try:
+            envy.waiter().wait(server_ids, envy.cloud_api.is_server_deleted,
+                               'Envys were not deleted in time')
+        except exceptions.WaitError as exc:
+            names = [name for name, server in servers.iteritems()
+                     if server.id in exc.pending]
+            raise SystemExit('%s: %s' % (exc, ', '.join(sorted(names))))
+
+        logging.info('Destroyed %d Envy(s).', len(server_ids))
+        if failed:
+            raise SystemExit(1)
@@ -1,12 +1,15 @@
+import hashlib
 import logging
-import tarfile
-import tempfile
 import os
-
-import fabric.api
-import fabric.operations
+import posixpath
 
 import cloudenvy.core
+import cloudenvy.ssh
+import cloudenvy.sync
+import cloudenvy.transfer
+
+
+DIGEST_PATH = '~/.cloudenvy/dotfiles.sha256'
 
 
 class Dotfiles(cloudenvy.core.Command):
@@ -21,32 +24,66 @@ class Dotfiles(cloudenvy.core.Command):
         subparser.add_argument('-f', '--files', action='store',
                                help='Limit operation to a specific list of '
                                     'comma-separated files.')
+        subparser.add_argument('--compress', action='store',
+                               choices=cloudenvy.transfer.COMPRESS_CHOICES,
+                               help='Compress the dotfiles on the way up '
+                                    '(`auto` picks by link speed).')
+        subparser.add_argument('--force', action='store_true',
+                               help='Upload the dotfiles even if the Envy '
+                                    'already has them.')
         return subparser
 
     def run(self, config, args):
         envy = cloudenvy.core.Envy(config)
 
         if envy.ip():
-            host_string = '%s@%s' % (envy.config.remote_user, envy.ip())
+            connection = envy.connection()
 
-            temp_tar = tempfile.NamedTemporaryFile(delete=True)
+            if args.files:
+                dotfiles = args.files.split(',')
+            else:
+                dotfiles = config['defaults']['dotfiles'].split(',')
 
-            with fabric.api.settings(host_string=host_string):
-                if args.files:
-                    dotfiles = args.files.split(',')
-                else:
-                    dotfiles = config['defaults']['dotfiles'].split(',')
+            dotfiles = [dotfile.strip() for dotfile in dotfiles]
 
-                dotfiles = [dotfile.strip() for dotfile in dotfiles]
+            mappings = []
+            for dotfile in dotfiles:
+                path = os.path.expanduser('~/%s' % dotfile)
+                if os.path.exists(path):
+                    if not os.path.islink(path):
+                        remote_dir = posixpath.dirname(
+                            posixpath.join('~', dotfile))
+                        mappings.append((path, remote_dir + '/'))
 
-                with tarfile.open(temp_tar.name, 'w') as archive:
-                    for dotfile in dotfiles:
-                        path = os.path.expanduser('~/%s' % dotfile)
-                        if os.path.exists(path):
-                            if not os.path.islink(path):
-                                archive.add(path, arcname=dotfile)
+            entries, dirs = cloudenvy.sync.walk(mappings, set(['~']))
+            digest = self._digest(entries)
 
-                fabric.operations.put(temp_tar, '~/dotfiles.tar')
-                fabric.operations.run('tar -xvf ~/dotfiles.tar')
+            status, stdout, stderr = connection.exec_command(
+                'cat %s 2>/dev/null; true'
+                % cloudenvy.ssh.quote_path(DIGEST_PATH))
+            if stdout.strip() == digest and not args.force:
+                logging.info('Dotfiles on the Envy are up to date.')
+                return
+
+            # The digest is only written once the archive has been
+            # extracted, so an interrupted upload is retried next time.
+            save_digest = 'mkdir -p %s && echo %s > %s' % (
+                cloudenvy.ssh.quote_path(posixpath.dirname(DIGEST_PATH)),
+                digest, cloudenvy.ssh.quote_path(DIGEST_PATH))
+            cloudenvy.transfer.upload(
+                connection,
+                [(entry.local_path, entry.remote_path) for entry in entries],
+                dirs - set(['~']),
+                compress=args.compress or envy.config.compress,
+                then=save_digest)
         else:
             logging.error('Could not determine IP.')
+
+    def _digest(self, entries):
+        """Digest of the names, modes and contents of the dotfile set."""
+        digest = hashlib.sha256()
+        for entry in sorted(entries):
+            digest.update('%s\0%o\0%s\n' % (
+                entry.remote_path, entry.mode,
+                cloudenvy.sync.file_hash(entry.local_path)))
+        return digest.hexdigest()
@@ -1,11 +1,9 @@
 import logging
-import time
 import os
 
-import fabric.api
-import fabric.operations
-
 import cloudenvy.core
+import cloudenvy.sync
+import cloudenvy.transfer
 
 
 class Files(cloudenvy.core.Command):
@@ -13,71 +11,60 @@ class Files(cloudenvy.core.Command):
     def _build_subparser(self, subparsers):
         help_str = 'Upload arbitrary files from your local machine to an ' \
                    'Envy. Uses the `files` hash in your Envyfile. Mirrors ' \
-                   'the local mode of the file.'
+                   'the local mode of the file. Only files that changed ' \
+                   'since the last upload are transferred.'
         subparser = subparsers.add_parser('files', help=help_str,
                                           description=help_str)
         subparser.set_defaults(func=self.run)
         subparser.add_argument('-n', '--name', action='store', default='',
                                help='Specify custom name for an Envy.')
+        subparser.add_argument('--force', action='store_true',
+                               help='Upload every file, even if the Envy '
+                                    'already has it.')
+        subparser.add_argument('--compress', action='store',
+                               choices=cloudenvy.transfer.COMPRESS_CHOICES,
+                               help='Compress the files on the way up '
+                                    '(`auto` picks by link speed).')
         return subparser
 
-    def run(self, config, args):
-        envy = cloudenvy.core.Envy(config)
+    def run(self, config, args, envy=None):
+        envy = envy or cloudenvy.core.Envy(config)
 
         if envy.ip():
-            host_string = '%s@%s' % (envy.config.remote_user, envy.ip())
-
-            with fabric.api.settings(host_string=host_string):
-                use_sudo = envy.config.project_config.get('files_use_sudo', True)
-                files = envy.config.project_config.get('files', {}).items()
-                files = [(os.path.expanduser(loc), rem) for loc, rem in files]
-
-                for local_path, remote_path in files:
-                    logging.info("Copying file from '%s' to '%s'",
-                                 local_path, remote_path)
-
-                    if not os.path.exists(local_path):
-                        logging.error("Local file '%s' not found.", local_path)
-
-                    dest_dir = _parse_directory(remote_path)
-                    if dest_dir:
-                        self._create_directory(dest_dir)
-                    self._put_file(local_path, remote_path, use_sudo)
+            envy.wait_for_ssh()
+            connection = envy.connection()
+            use_sudo = envy.config.project_config.get('files_use_sudo', True)
+            files = envy.config.project_config.get('files', {}).items()
+            files = [(os.path.expanduser(loc), rem) for loc, rem in files]
+
+            remote_dirs, manifest = cloudenvy.sync.remote_state(
+                connection, [rem for loc, rem in files
+                             if not os.path.isdir(loc)])
+            if getattr(args, 'force', False):
+                manifest = {}
+
+            entries, dest_dirs = cloudenvy.sync.walk(files, remote_dirs)
+            changes, updated = cloudenvy.sync.changed(entries, manifest)
+            logging.info('%d of %d file(s) changed.', len(changes),
+                         len(entries))
+
+            for entry in changes:
+                logging.info("Copying file from '%s' to '%s'",
+                             entry.local_path, entry.remote_path)
+
+            # All changed files go up as one tar stream, which also
+            # creates their destination directories.
+            if changes:
+                cloudenvy.transfer.upload(
+                    connection,
+                    [(entry.local_path, entry.remote_path)
+                     for entry in changes],
+                    dest_dirs, use_sudo,
+                    getattr(args, 'compress', None) or envy.config.compress)
+
+            if updated != manifest:
+                cloudenvy.sync.save_manifest(connection, updated)
 
         else:
             logging.error('Could not determine IP.')
 
-    def _create_directory(self, remote_dir):
-        for i in range(24):
-            try:
-                fabric.operations.run('mkdir -p %s' % remote_dir)
-                break
-            except fabric.exceptions.NetworkError:
-                logging.debug("Unable to create directory '%s'. "
-                              "Trying again in 10 seconds." % remote_dir)
-                time.sleep(10)
-
-    def _put_file(self, local_path, remote_path, use_sudo):
-        for i in range(24):
-            try:
-                fabric.operations.put(local_path, remote_path,
-                                      mirror_local_mode=True,
-                                      use_sudo=use_sudo)
-                break
-            except fabric.exceptions.NetworkError as err:
-                logging.debug("Unable to upload the file from '%s': %s. "
-                              "Trying again in 10 seconds." %
-                              (local_path, err))
-                time.sleep(10)
-
-
-def _parse_directory(path):
-    """Given a valid unix path, return the directory
-
-    This will not expand a ~ to a home directory or
-    prepend that home directory to a relative path.
-    """
-    if path is None or '/' not in path:
-        return None
-    else:
-        return os.path.dirname(path)
@@ -27,6 +27,8 @@ project_file = """project_config:
 
 class Init(cloudenvy.core.Command):
 
+    requires = cloudenvy.core.REQUIRES_NOTHING
+
     def _build_subparser(self, subparsers):
         help_str = 'Initialize a new cloudenvy project.'
         subparser = subparsers.add_parser('init', help=help_str,
@@ -1,4 +1,5 @@
 import cloudenvy.core
+import cloudenvy.pool
 
 
 class List(cloudenvy.core.Command):
@@ -8,11 +9,27 @@ class List(cloudenvy.core.Command):
         subparser = subparsers.add_parser('list', help=help_str,
                                           description=help_str)
         subparser.set_defaults(func=self.run)
+        subparser.add_argument('--cached', action='store_true',
+                               help='List the Envys recorded locally '
+                                    'instead of asking the cloud. Only '
+                                    'Envys created or used from this '
+                                    'machine are known.')
         return subparser
 
+    def requirements(self, args):
+        if args.cached:
+            return cloudenvy.core.REQUIRES_CONFIG
+        return cloudenvy.core.REQUIRES_CLOUD
+
     def run(self, config, args):
         envy = cloudenvy.core.Envy(config)
 
-        for server in envy.list_servers():
-            if server.name.startswith(envy.name):
-                print server.name[len(envy.name)+1:] or '(default)'
+        if args.cached:
+            names = envy.state.names()
+        else:
+            names = [server.name for server in envy.list_servers()]
+
+        for name in names:
+            if name.startswith(envy.name) \
+                    and not cloudenvy.pool.is_standby(config, name):
+                print name[len(envy.name)+1:] or '(default)'
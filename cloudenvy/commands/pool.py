@@ -0,0 +1,180 @@
+import logging
+
+from cloudenvy import exceptions
+import cloudenvy.core
+import cloudenvy.fleet
+import cloudenvy.pool
+import cloudenvy.provisioning
+import cloudenvy.userdata
+
+
+class Pool(cloudenvy.core.Command):
+
+    def _build_subparser(self, subparsers):
+        help_str = 'Manage the pool of standby Envys.'
+        description = ('Keep booted, provisioned standby Envys around, so '
+                       'that `envy up` can claim one in seconds instead of '
+                       'booting a new one. `envy up` refills the pool in '
+                       'the background as standbys are claimed.')
+        subparser = subparsers.add_parser('pool', help=help_str,
+                                          description=description)
+        subparser.set_defaults(func=self.run, scripts=None)
+
+        subparser.add_argument('action', choices=['fill', 'drain'],
+                               help='Boot standbys until the pool has SIZE '
+                                    'of them, or delete every standby.')
+        subparser.add_argument('--size', type=int, default=None,
+                               metavar='N',
+                               help='Number of standby Envys to keep '
+                                    '(defaults to that of the last fill).')
+        subparser.add_argument('--no-files', action='store_true',
+                               help='Prevent files from being uploaded to '
+                                    'standbys.')
+        subparser.add_argument('--no-provision', action='store_true',
+                               help='Prevent provision scripts from running '
+                                    'on standbys.')
+        subparser.add_argument('--parallel', type=int,
+                               default=cloudenvy.fleet.DEFAULT_PARALLELISM,
+                               metavar='N',
+                               help='Maximum number of standbys to boot at '
+                                    'once.')
+        return subparser
+
+    def run(self, config, args):
+        if args.action == 'fill':
+            self._fill(config, args)
+        elif args.action == 'drain':
+            self._drain(config, args)
+
+    def _fill(self, config, args):
+        size = args.size
+        if size is None:
+            size = (cloudenvy.pool.settings(config) or {}).get('size')
+        if size is None or size < 0:
+            raise SystemExit('Use --size to set the size of the pool.')
+
+        scripts = None
+        if cloudenvy.provisioning.wanted(config.project_config,
+                                         args.no_provision):
+            scripts = cloudenvy.provisioning.find_scripts(
+                config.project_config)
+        cloudenvy.pool.remember(config, size, not args.no_files,
+                                scripts is not None)
+
+        with cloudenvy.pool.fill_lock(config) as locked:
+            if not locked:
+                logging.info('The pool is already being filled.')
+                return
+            self._top_up(config, args, size, scripts)
+
+    def _top_up(self, config, args, size, scripts):
+        envy = cloudenvy.core.Envy(config)
+        key = cloudenvy.pool.pool_key(envy, files=not args.no_files,
+                                      scripts=scripts)
+
+        # Standbys booted for another image, Envyfile or set of files can
+        # never be claimed.
+        standbys = []
+        for server in cloudenvy.pool.members(envy):
+            if server.name.startswith(cloudenvy.pool.name_prefix(
+                    config, cloudenvy.pool.STANDBY, key)):
+                standbys.append(server)
+            else:
+                logging.info('Deleting outdated standby \'%s\'.',
+                             server.name)
+                envy.cloud_api.delete_server(server)
+        warming = cloudenvy.pool.members(envy, cloudenvy.pool.WARMING, key)
+
+        count = size - len(standbys) - len(warming)
+        if count <= 0:
+            logging.info('The pool has %d standby Envy(s) and %d on the '
+                         'way.', len(standbys), len(warming))
+            return
+
+        userdata = None
+        if config.provision_mode == 'cloud-init':
+            userdata = cloudenvy.userdata.build(
+                config, files=not args.no_files, scripts=scripts)
+
+        logging.info('Booting %d standby Envy(s).', count)
+        names = [cloudenvy.pool.new_name(config, key)
+                 for i in xrange(count)]
+        results = cloudenvy.fleet.boot(config, names, args.parallel,
+                                       userdata)
+
+        #NOTE: fabric keeps its connection state in globals, so standbys
+        # that are provisioned over SSH are provisioned one at a time.
+        filled = 0
+        for result in results:
+            standby = cloudenvy.core.Envy(config, name=result.name)
+            try:
+                if result.error is not None:
+                    raise result.error
+                self._provision(config, args, standby, userdata, scripts)
+                envy.cloud_api.rename_server(
+                    standby.server(),
+                    cloudenvy.pool.standby_name(config, result.name))
+            except (Exception, SystemExit) as exc:
+                logging.error('Standby \'%s\' failed: %s', result.name, exc)
+                self._discard(standby)
+                continue
+            standby.state.forget(standby.name)
+            filled += 1
+
+        logging.info('Added %d standby Envy(s) to the pool.', filled)
+        if filled < count:
+            raise SystemExit(1)
+
+    def _provision(self, config, args, standby, userdata, scripts):
+        standby.wait_for_ssh()
+        if userdata:
+            status = cloudenvy.userdata.wait(standby.connection(),
+                                             config.provision_timeout)
+            if status:
+                raise SystemExit('Provisioning during boot failed.')
+            return
+        if not args.no_files:
+            self.commands['files'].run(config, args, envy=standby)
+        if scripts is not None:
+            self.commands['provision'].run(config, args, envy=standby)
+
+    def _discard(self, standby):
+        try:
+            if standby.server():
+                standby.delete_server()
+        except (Exception, SystemExit) as exc:
+            logging.warning('Unable to delete \'%s\': %s', standby.name, exc)
+
+    def _drain(self, config, args):
+        envy = cloudenvy.core.Envy(config)
+        cloudenvy.pool.forget(config)
+        servers = dict((server.name, server) for server in
+                       cloudenvy.pool.members(envy) +
+                       cloudenvy.pool.members(envy, cloudenvy.pool.WARMING))
+        if not servers:
+            logging.info('The pool is empty.')
+            return
+
+        for name in sorted(servers):
+            logging.info('Deleting standby \'%s\'.', name)
+
+        def _delete(name):
+            envy.cloud_api.delete_server(servers[name])
+
+        failed = set()
+        for result in cloudenvy.fleet.run_concurrently(
+                _delete, sorted(servers), args.parallel):
+            if result.error is not None:
+                logging.error('Could not delete \'%s\': %s', result.name,
+                              result.error)
+                failed.add(result.name)
+
+        try:
+            envy.waiter().wait([server.id for name, server
+                                in servers.iteritems() if name not in failed],
+                               envy.cloud_api.is_server_deleted,
+                               'Standbys were not deleted in time')
+        except exceptions.WaitError as exc:
+            raise SystemExit(str(exc))
+        if failed:
+            raise SystemExit(1)
@@ -1,11 +1,11 @@
 import logging
-import os
-import time
 
-import fabric.api
 import fabric.operations
 
 import cloudenvy.core
+import cloudenvy.provisioning
+import cloudenvy.ssh
+import cloudenvy.transfer
 
 
 class Provision(cloudenvy.core.Command):
@@ -20,10 +20,13 @@ class Provision(cloudenvy.core.Command):
                                help='Specify custom name for an Envy.')
         subparser.add_argument('-s', '--scripts', nargs='*', metavar='PATH',
                                help='Specify one or more scripts.')
+        subparser.add_argument('--force', action='store_true',
+                               help='Run every script, even those that '
+                                    'already completed on the Envy.')
         return subparser
 
-    def run(self, config, args):
-        envy = cloudenvy.core.Envy(config)
+    def run(self, config, args, envy=None):
+        envy = envy or cloudenvy.core.Envy(config)
 
         logging.info('Running provision scripts for Envy \'%s\'.' %
                      envy.name)
@@ -31,40 +34,59 @@ class Provision(cloudenvy.core.Command):
             logging.error('Could not determine IP.')
             return
 
-        with fabric.api.settings(
-                host_string=envy.ip(), user=envy.config.remote_user,
-                forward_agent=True, disable_known_hosts=True):
+        scripts = cloudenvy.provisioning.find_scripts(
+            envy.config.project_config, args.scripts)
+        hashes = cloudenvy.provisioning.chain(
+            scripts, envy.config.project_config.get('provision_inputs', []))
+        envy.wait_for_ssh()
+        connection = envy.connection()
 
-            if args.scripts:
-                scripts = [os.path.expanduser(script) for
-                           script in args.scripts]
-            elif 'provision_scripts' in envy.config.project_config:
-                scripts = [os.path.expanduser(script) for script in
-                           envy.config.project_config['provision_scripts']]
-            elif 'provision_script_path' in envy.config.project_config:
-                provision_script = envy.config.project_config['provision_script_path']
-                scripts = [os.path.expanduser(provision_script)]
-            else:
-                raise SystemExit('Please specify the path to your provision '
-                                 'script(s) by either using the `--scripts` '
-                                 'flag, or by defining the `provision_scripts`'
-                                 ' config option in your Envyfile.')
+        # Scripts are skipped up to the first one whose hash isn't in the
+        # ledger; that one and everything after it run again.
+        status, ledger, stderr = connection.exec_command(
+            'cat %s 2>/dev/null; true' % cloudenvy.ssh.quote_path(
+                cloudenvy.provisioning.LEDGER_PATH))
+        ledger = set(ledger.split())
+        start = 0
+        if not getattr(args, 'force', False):
+            while start < len(scripts) and hashes[start] in ledger:
+                start += 1
+        if start == len(scripts):
+            logging.info('All provision scripts already completed on the '
+                         'Envy; use --force to run them again.')
+            return
+        if start:
+            logging.info('Skipping %d provision script(s) that already '
+                         'completed.', start)
+        pending = scripts[start:]
+
+        # The pending scripts go up in one transfer, which also clears the
+        # results of the previous run and drops the ledger entries of the
+        # scripts about to run again.
+        cloudenvy.transfer.upload(
+            connection,
+            [(local, remote) for index, local, remote in pending],
+            then='chmod 755 %s && mkdir -p ~/.cloudenvy && : > %s '
+                 '&& printf "%%s\\n" %s > %s' % (
+                     ' '.join([cloudenvy.ssh.quote_path(remote)
+                               for index, local, remote in pending]),
+                     cloudenvy.ssh.quote_path(
+                         cloudenvy.provisioning.RESULTS_PATH),
+                     ' '.join(hashes[:start]),
+                     cloudenvy.ssh.quote_path(
+                         cloudenvy.provisioning.LEDGER_PATH)))
 
-            for script in scripts:
-                logging.info('Running provision script from \'%s\'', script)
+        failed = False
+        with connection.settings(warn_only=True):
+            for batch in cloudenvy.provisioning.batches(pending):
+                logging.info('Running provision script(s) from %s',
+                             ', '.join(['\'%s\'' % local
+                                        for index, local, remote in batch]))
+                runner = cloudenvy.provisioning.runner(batch, hashes)
+                if fabric.operations.run(runner).failed:
+                    failed = True
+                    break
 
-                for i in range(24):
-                    try:
-                        path = script
-                        filename = os.path.basename(script)
-                        remote_path = '~/%s' % filename
-                        fabric.operations.put(path, remote_path, mode=0755)
-                        fabric.operations.run(remote_path)
-                        break
-                    except fabric.exceptions.NetworkError:
-                        logging.debug(
-                            'Unable to upload the provision script '
-                            'from `%s`. Trying again in 10 seconds.' % path
-                        )
-                        time.sleep(10)
-                logging.info('Provision script \'%s\' finished.' % path)
+        cloudenvy.provisioning.report(connection, scripts, start)
+        if failed:
+            raise SystemExit('Provisioning failed.')
@@ -1,9 +1,44 @@
 import logging
+import subprocess
+import sys
+import threading
 
-import fabric.api
 import fabric.operations
 
 import cloudenvy.core
+import cloudenvy.fleet
+
+
+class _Prefixer(object):
+    """Write output from many Envys as whole lines prefixed with the name.
+
+    Lines from different Envys never interleave mid-line.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, name, width):
+        self.prefix = '%-*s | ' % (width, name)
+        self.partial = {False: '', True: ''}
+
+    def write(self, data, is_stderr=False):
+        lines = (self.partial[is_stderr] + data).split('\n')
+        self.partial[is_stderr] = lines.pop()
+        if lines:
+            self._emit(lines, is_stderr)
+
+    def flush(self):
+        for is_stderr in (False, True):
+            if self.partial[is_stderr]:
+                self._emit([self.partial[is_stderr]], is_stderr)
+                self.partial[is_stderr] = ''
+
+    def _emit(self, lines, is_stderr):
+        stream = sys.stderr if is_stderr else sys.stdout
+        with self._lock:
+            stream.write(''.join(['%s%s\n' % (self.prefix, line)
+                                  for line in lines]))
+            stream.flush()
 
 
 class Run(cloudenvy.core.Command):
@@ -17,14 +52,81 @@ class Run(cloudenvy.core.Command):
         subparser.add_argument('command', help='Command to execute remotely.')
         subparser.add_argument('-n', '--name', action='store', default='',
                                help='Specify custom name for an Envy.')
+        group = subparser.add_mutually_exclusive_group()
+        group.add_argument('--all', action='store_true',
+                           help='Run the command on every Envy in your '
+                                'current project.')
+        group.add_argument('--prefix', action='store', default=None,
+                           help='Run the command on every Envy in your '
+                                'current project whose name starts with '
+                                'PREFIX.')
+        subparser.add_argument('--parallel', type=int,
+                               default=cloudenvy.fleet.DEFAULT_PARALLELISM,
+                               metavar='N',
+                               help='Maximum number of Envys to run the '
+                                    'command on at once with --all or '
+                                    '--prefix.')
         return subparser
 
     def run(self, config, args):
+        if args.all or args.prefix is not None:
+            return self._run_many(config, args)
+
         envy = cloudenvy.core.Envy(config)
 
         if envy.ip():
-            host_string = '%s@%s' % (envy.config.remote_user, envy.ip())
-            with fabric.api.settings(host_string=host_string):
-                fabric.operations.run(args.command)
+            connection = envy.connection()
+            if connection.master_alive():
+                # An earlier invocation left an authenticated ControlMaster
+                # behind, which is cheaper than a fresh handshake.
+                status = subprocess.call(connection.ssh_command(args.command))
+                if status == 255:
+                    envy.forget_ip()
+                if status:
+                    raise SystemExit(status)
+            else:
+                with connection.settings():
+                    fabric.operations.run(args.command)
         else:
             logging.error('Could not determine IP.')
+
+    def _run_many(self, config, args):
+        servers = cloudenvy.fleet.select(cloudenvy.core.Envy(config),
+                                         None if args.all else args.prefix)
+        if not servers:
+            logging.error('Could not find any matching Envys.')
+            return
+
+        servers = dict((server.name, server) for server in servers)
+        names = sorted(servers)
+        width = max(len(name) for name in names)
+
+        def _run(name):
+            envy = cloudenvy.core.Envy(config, name=name)
+            envy.adopt(servers[name])
+            if not envy.ip():
+                raise SystemExit('Could not determine IP.')
+            output = _Prefixer(name, width)
+            try:
+                status, stdout, stderr = envy.connection().exec_command(
+                    args.command, on_output=output.write)
+            finally:
+                output.flush()
+            return status
+
+        results = cloudenvy.fleet.run_concurrently(_run, names,
+                                                   args.parallel)
+
+        rows = []
+        for result in results:
+            if result.error is not None:
+                logging.error('%s: %s', result.name, result.error)
+                status = 'error'
+            else:
+                status = result.value
+            rows.append((result.name, status, '%.1f' % result.elapsed))
+        cloudenvy.fleet.print_table(('NAME', 'EXIT', 'SECONDS'), rows)
+
+        if any(result.error is not None or result.value
+               for result in results):
+            raise SystemExit(1)
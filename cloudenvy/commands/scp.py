@@ -1,10 +1,11 @@
+import glob
 import logging
-
-import fabric.api
-import fabric.operations
 import os
 
+import cloudenvy.chunked
 import cloudenvy.core
+import cloudenvy.sync
+import cloudenvy.transfer
 
 
 class Scp(cloudenvy.core.Command):
@@ -28,6 +29,24 @@ class Scp(cloudenvy.core.Command):
             '-n', '--name', action='store', default='',
             help='Specify custom name for an Envy.'
         )
+        subparser.add_argument(
+            '--compress', action='store',
+            choices=cloudenvy.transfer.COMPRESS_CHOICES,
+            help='Compress the file(s) on the way up (`auto` picks by link '
+            'speed and how well the data compresses).'
+        )
+        subparser.add_argument(
+            '--chunk-threshold', type=int,
+            default=cloudenvy.chunked.DEFAULT_THRESHOLD // (1024 * 1024),
+            help='Upload files of at least this many MB in resumable, '
+            'checksummed chunks (default: %(default)s).'
+        )
+        subparser.add_argument(
+            '--parallel', type=int,
+            default=cloudenvy.chunked.DEFAULT_PARALLELISM,
+            help='Number of chunks of a large file to upload at once '
+            '(default: %(default)s).'
+        )
         return subparser
 
     def run(self, config, args):
@@ -37,9 +56,30 @@ class Scp(cloudenvy.core.Command):
             logging.error('Could not determine IP.')
             return
 
-        host_string = '%s@%s' % (envy.config.remote_user, envy.ip())
+        # Same source and target rules as fabric's put (~ and globs are
+        # expanded locally), with local modes mirrored, but small files are
+        # sent as a single tar stream (which also creates the directories)
+        # and large ones in chunks.
+        sources = sorted(glob.glob(os.path.expanduser(args.source)))
+        if not sources:
+            raise SystemExit("'%s' is not a valid local path or glob."
+                             % args.source)
+        connection = envy.connection()
+        target_dirs = cloudenvy.sync.remote_dirs(connection, [args.target])
+        entries, dirs = cloudenvy.sync.walk(
+            [(source, args.target) for source in sources], target_dirs)
+        threshold = args.chunk_threshold * 1024 * 1024
+        small = [entry for entry in entries if entry.size < threshold]
+        large = [entry for entry in entries if entry.size >= threshold]
 
-        with fabric.api.settings(host_string=host_string):
-            fabric.operations.put(
-                args.source, args.target, mirror_local_mode=True
+        if small or dirs:
+            cloudenvy.transfer.upload(
+                connection,
+                [(entry.local_path, entry.remote_path) for entry in small],
+                dirs, compress=args.compress or envy.config.compress
             )
+        for entry in large:
+            cloudenvy.chunked.Upload(
+                connection, entry.local_path, entry.remote_path,
+                parallelism=args.parallel
+            ).run()
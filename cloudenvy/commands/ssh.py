@@ -1,7 +1,5 @@
 import logging
-
-import fabric.api
-import fabric.operations
+import subprocess
 
 import cloudenvy.core
 
@@ -22,16 +20,12 @@ class Ssh(cloudenvy.core.Command):
         envy = cloudenvy.core.Envy(config)
 
         if envy.ip():
-            disable_known_hosts = ('-o UserKnownHostsFile=/dev/null'
-                                   ' -o StrictHostKeyChecking=no')
-            forward_agent = '-o ForwardAgent=yes'
-
-            options = [disable_known_hosts]
-            if envy.config.forward_agent:
-                options.append(forward_agent)
+            status = subprocess.call(envy.connection().ssh_command())
 
-            fabric.operations.local('ssh %s %s@%s' % (' '.join(options),
-                                                      envy.config.remote_user,
-                                                      envy.ip()))
+            # ssh exits with 255 when it could not connect at all.
+            if status == 255:
+                envy.forget_ip()
+            if status:
+                raise SystemExit(status)
         else:
             logging.error('Could not determine IP.')
@@ -1,7 +1,13 @@
 import logging
+import time
 
 from cloudenvy import exceptions
 import cloudenvy.core
+import cloudenvy.fleet
+import cloudenvy.imagecache
+import cloudenvy.pool
+import cloudenvy.provisioning
+import cloudenvy.userdata
 
 
 class Up(cloudenvy.core.Command):
@@ -22,35 +28,189 @@ class Up(cloudenvy.core.Command):
                                help='Prevent files from being uploaded')
         subparser.add_argument('--no-provision', action='store_true',
                                help='Prevent provision scripts from running.')
+        subparser.add_argument('--count', type=int, default=None,
+                               metavar='N',
+                               help='Boot a fleet of N Envys named '
+                                    '<name>-1 through <name>-N.')
+        subparser.add_argument('--parallel', type=int,
+                               default=cloudenvy.fleet.DEFAULT_PARALLELISM,
+                               metavar='N',
+                               help='Maximum number of Envys to boot at '
+                                    'once in fleet mode.')
         return subparser
 
     def run(self, config, args):
+        if args.count is not None:
+            return self._run_fleet(config, args)
+
         envy = cloudenvy.core.Envy(config)
+        provision = self._wants_provision(config, args)
 
+        userdata = None
+        cache_key = image = None
+        claimed = False
         if not envy.server():
+            claimed = self._claim_standby(envy, args, provision)
+        if not claimed and not envy.server():
+            if config.image_cache:
+                cache_key, image = self._cached_image(envy, args, provision)
+            if image is None and config.provision_mode == 'cloud-init':
+                userdata, scripts = self._userdata(config, args)
+
             logging.info('Triggering Envy boot.')
             try:
-                envy.build_server()
+                envy.build_server(userdata, image)
             except exceptions.ImageNotFound:
                 logging.error('Could not find image.')
                 return
             except exceptions.NoIPsAvailable:
                 logging.error('Could not find available IP.')
                 return
+            envy.wait_for_ssh()
+
+        if claimed:
+            logging.info('Files and provision scripts came with the standby '
+                         'Envy.')
+        elif image is not None:
+            logging.info('Files and provision scripts came with the cached '
+                         'image.')
+        elif userdata:
+            self._wait_for_boot_provisioning(envy, scripts)
+        else:
+            self._provision_over_ssh(config, args, envy, provision)
+
+        if cache_key and image is None:
+            self._save_image(envy, cache_key)
+
+        if envy.ip():
+            print envy.ip()
+        else:
+            logging.error('Could not determine IP.')
+
+    def _wants_provision(self, config, args):
+        return cloudenvy.provisioning.wanted(config.project_config,
+                                             args.no_provision)
+
+    def _claim_standby(self, envy, args, provision):
+        """Claim a matching standby Envy from the pool, if there is one.
+
+        Whether or not one was claimed, the pool is refilled in the
+        background.
+        """
+        if not cloudenvy.pool.settings(envy.config):
+            return False
+
+        scripts = None
+        if provision:
+            scripts = cloudenvy.provisioning.find_scripts(
+                envy.config.project_config, args.scripts)
+        start = time.time()
+        key = cloudenvy.pool.pool_key(envy, files=not args.no_files,
+                                      scripts=scripts)
+        server = cloudenvy.pool.claim(envy, key)
+        if server is None:
+            logging.info('No matching standby Envy is ready; booting a new '
+                         'one.')
+        else:
+            logging.info('Claimed standby Envy in %.1fs.',
+                         time.time() - start)
+        cloudenvy.pool.refill_in_background(envy.config, args.cloud)
+        return server is not None
+
+    def _cached_image(self, envy, args, provision):
+        """Return the image cache key for this Envy and its image, if any."""
+        scripts = None
+        if provision:
+            scripts = cloudenvy.provisioning.find_scripts(
+                envy.config.project_config, args.scripts)
+        key = cloudenvy.imagecache.cache_key(envy, files=not args.no_files,
+                                             scripts=scripts)
+        image = cloudenvy.imagecache.lookup(envy.cloud_api, key)
+        if image is None:
+            logging.info('No cached image for this Envy yet; it will be '
+                         'saved once provisioning is done.')
+        return key, image
+
+    def _save_image(self, envy, key):
+        #NOTE: the Envy is already usable at this point, so failing to cache
+        # it is not worth failing `envy up` over.
+        try:
+            cloudenvy.imagecache.store(envy, key)
+            cloudenvy.imagecache.evict(envy.cloud_api,
+                                       envy.config.base_name,
+                                       envy.config.image_cache_quota)
+        except Exception as exc:
+            logging.warning('Unable to save the Envy as a cached image: %s',
+                            exc)
+
+    def _userdata(self, config, args):
+        """Return user data that provisions during boot, and its scripts."""
+        scripts = None
+        if self._wants_provision(config, args):
+            scripts = cloudenvy.provisioning.find_scripts(
+                config.project_config, args.scripts)
+        return (cloudenvy.userdata.build(config, files=not args.no_files,
+                                         scripts=scripts), scripts)
+
+    def _wait_for_boot_provisioning(self, envy, scripts):
+        logging.info('Waiting for provisioning during boot to finish.')
+        connection = envy.connection()
+        status = cloudenvy.userdata.wait(connection,
+                                         envy.config.provision_timeout)
+        if scripts:
+            cloudenvy.provisioning.report(connection, scripts)
+        if status:
+            raise SystemExit('Provisioning during boot failed; see '
+                             '/var/log/cloud-init-output.log on the Envy. '
+                             '`envy provision` resumes from the failed '
+                             'script.')
+
+    def _provision_over_ssh(self, config, args, envy, provision):
         if not args.no_files:
-            self.commands['files'].run(config, args)
-        if not args.no_provision \
-                and (envy.config.project_config.get("auto_provision", True)
-                     and 'provision_scripts' in envy.config.project_config):
+            self.commands['files'].run(config, args, envy=envy)
+        if provision:
+            # Only a missing script list gets this hint; a failing script
+            # or an unreachable Envy exits with its own message.
             try:
-                self.commands['provision'].run(config, args)
+                cloudenvy.provisioning.find_scripts(config.project_config,
+                                                    args.scripts)
             except SystemExit:
                 raise SystemExit('You have not specified any provision '
                                  'scripts in your Envyfile. '
                                  'If you would like to run your Envy '
                                  'without a provision script; use the '
                                  '`--no-provision` command line flag.')
-        if envy.ip():
-            print envy.ip()
-        else:
-            logging.error('Could not determine IP.')
+            self.commands['provision'].run(config, args, envy=envy)
+
+    def _run_fleet(self, config, args):
+        if args.count < 1:
+            raise SystemExit('--count must be at least 1.')
+
+        #NOTE: fabric keeps its connection state in globals, so files and
+        # provision scripts are not pushed to a fleet over SSH. With
+        # provision_mode set to cloud-init they are handed to every new Envy
+        # as user data instead, and run in the background as they boot.
+        userdata = None
+        if config.provision_mode == 'cloud-init':
+            userdata, scripts = self._userdata(config, args)
+
+        logging.info('Triggering boot of %d Envys.', args.count)
+        names = cloudenvy.fleet.fleet_names(
+            config.project_config['name'], args.count)
+        results = cloudenvy.fleet.boot(config, names, args.parallel,
+                                       userdata)
+
+        rows = []
+        for result in results:
+            if result.error is not None:
+                logging.error('%s: %s', result.name, result.error)
+                status, ip = 'failed', None
+            else:
+                status, ip = result.value
+            rows.append((result.name, status, ip or '-',
+                         '%.1f' % result.elapsed))
+        cloudenvy.fleet.print_table(('NAME', 'STATUS', 'IP', 'SECONDS'),
+                                    rows)
+
+        if any(result.error is not None for result in results):
+            raise SystemExit(1)
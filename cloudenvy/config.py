@@ -15,6 +15,15 @@ CONFIG_DEFAULTS = {
         'forward_agent': True,
         'default_cloud': None,
         'network_id': None,
+        'wait_timeout': 120,
+        'ssh_timeout': 240,
+        'catalog_ttl': 86400,
+        'ssh_control_persist': None,
+        'compress': 'none',
+        'provision_mode': 'ssh',
+        'provision_timeout': 1800,
+        'image_cache': False,
+        'image_cache_quota': 3,
         'dotfiles': '.vimrc, .gitconfig, .gitignore, .screenrc',
         'sec_groups': [
             'icmp, -1, -1, 0.0.0.0/0',
@@ -33,6 +42,12 @@ class EnvyConfig(object):
         self.project_config = config['project_config']
         self.default_config = config['defaults']
 
+        # The cloud API shared by every Envy of this config, built by
+        # cloudenvy.core.cloud_api() the first time one needs it. offline
+        # is set for commands that must not use the cloud at all.
+        self.cloud_api = None
+        self.offline = False
+
         image_name = self.project_config.get('image_name')
         image_id = self.project_config.get('image_id', None)
         image = self.project_config.get('image')
@@ -49,9 +64,19 @@ class EnvyConfig(object):
         self.keypair_name = self._get_config('keypair_name')
         self.keypair_location = self._get_config('keypair_location')
         self.forward_agent = self._get_config('forward_agent')
-
+        self.ssh_control_persist = self._get_config('ssh_control_persist')
+        self.compress = self._get_config('compress')
+        self.provision_mode = self._get_config('provision_mode')
+        self.provision_timeout = self._get_config('provision_timeout')
+        self.image_cache = self._get_config('image_cache')
+        self.image_cache_quota = self._get_config('image_cache_quota')
+
+        self.cloud_name = self.user_config.get('cloud_name')
         self.cloud_type = 'openstack' if 'os_auth_url' in self.user_config['cloud'] else 'ec2'
         self.network_id = self._get_config('network_id')
+        self.wait_timeout = self._get_config('wait_timeout')
+        self.ssh_timeout = self._get_config('ssh_timeout')
+        self.catalog_ttl = self._get_config('catalog_ttl')
 
     def _get_config(self, name, default=None):
         """Traverse the various config files in order of specificity.
@@ -101,7 +126,8 @@ class Config(object):
 
         if cloud_name in known_clouds:
             config['cloudenvy'].update(
-                {'cloud': config['cloudenvy']['clouds'][cloud_name]})
+                {'cloud': config['cloudenvy']['clouds'][cloud_name],
+                 'cloud_name': cloud_name})
         else:
             logging.error("Cloud %s is not found in your config" % cloud_name)
             logging.debug(
@@ -1,136 +1,301 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
 import logging
-import novaclient
+import threading
 import time
 
 import cloudenvy.clouds
+import cloudenvy.state
+import cloudenvy.tasks
+import cloudenvy.waiter
 from cloudenvy import exceptions
 
 
+_cloud_api_lock = threading.Lock()
+
+
+def cloud_api(config):
+    """Return the cloud API of config, building it on first use.
+
+    There is one per config, so Envys booted together (e.g. a fleet)
+    share one client and only authenticate, or prompt for a password,
+    once.
+    """
+    with _cloud_api_lock:
+        if config.cloud_api is None:
+            if config.offline:
+                raise RuntimeError('This command must not use the cloud.')
+            cls = cloudenvy.clouds.get_api_cls(config.cloud_type)
+            config.cloud_api = cls(config)
+        return config.cloud_api
+
+
 class Envy(object):
-    def __init__(self, config):
+    def __init__(self, config, name=None):
         self.config = config
-        self.name = config.project_config.get('name')
+        self.name = name or config.project_config.get('name')
 
-        cls = cloudenvy.clouds.get_api_cls(self.config.cloud_type)
-        self.cloud_api = cls(config)
+        self._cloud_api = None
+        self.state = cloudenvy.state.State(config.cloud_name)
 
         self._server = None
         self._ip = None
+        self._connection = None
+        self._booted_at = None
+        self._ssh_ready = False
+
+    @property
+    def cloud_api(self):
+        if not self._cloud_api:
+            self._cloud_api = cloud_api(self.config)
+        return self._cloud_api
 
     def list_servers(self):
         return self.cloud_api.list_servers()
 
     def find_server(self):
-        return self.cloud_api.find_server(self.name)
+        entry = self.state.get(self.name)
+        if entry:
+            server = self.cloud_api.get_server(entry['id'])
+            if self._is_live(server):
+                return server
+            logging.debug('Forgetting stale state for %s.', self.name)
+            self.state.forget(self.name)
+
+        server = self.cloud_api.find_server(self.name)
+        if server:
+            self.state.record(self.name, id=server.id)
+        return server
+
+    def _is_live(self, server):
+        return (server is not None and server.name == self.name
+                and not self.cloud_api.is_server_deleted(server))
 
     def delete_server(self):
         self.cloud_api.delete_server(self.server())
+        self.state.forget(self.name)
         self._server = None
 
+    def adopt(self, server):
+        """Make an existing server, e.g. a claimed standby, this Envy's."""
+        self.state.record(self.name, id=server.id)
+        self._server = server
+        self.forget_ip()
+
     def server(self):
         if not self._server:
             self._server = self.find_server()
         return self._server
 
     def ip(self):
-        if self.server():
+        server = self.server()
+        if server:
             if not self._ip:
-                self._ip = self.cloud_api.find_ip(self.server().id)
+                entry = self.state.get(self.name) or {}
+                if entry.get('id') == server.id and entry.get('ip'):
+                    self._ip = entry['ip']
+                else:
+                    self._ip = self.cloud_api.find_ip(server)
+                    if self._ip:
+                        self.state.record(self.name, id=server.id,
+                                          ip=self._ip)
             return self._ip
         else:
             raise SystemExit('The ENVy you specified (`%s`) does not exist. '
                              'Try using the -n flag to specify an ENVy name.'
                              % self.name)
 
-    def build_server(self):
-        logging.info("Using image: %s" % self.config.image)
+    def connection(self):
+        """The SSH connection shared by every remote operation on this Envy.
+
+        The ssh module (and with it fabric and paramiko) is only imported
+        by commands that actually talk to the Envy.
+        """
+        import cloudenvy.ssh
+
+        if not self._connection:
+            ip = self.ip()
+            if not ip:
+                raise SystemExit('Could not determine the IP of Envy \'%s\'.'
+                                 % self.name)
+            self._connection = cloudenvy.ssh.Connection(
+                ip, self.config.remote_user,
+                forward_agent=self.config.forward_agent,
+                control_persist=self.config.ssh_control_persist,
+                on_failure=self.forget_ip)
+        return self._connection
+
+    def forget_ip(self):
+        """Drop the remembered IP, e.g. after failing to connect to it."""
+        self._ip = None
+        self._connection = None
+        self._ssh_ready = False
+        self.state.forget(self.name, 'ip')
+
+    def wait_for_ssh(self):
+        """Wait until the Envy accepts SSH logins.
+
+        Only the first call on an Envy waits. For an Envy booted by
+        build_server, the time from boot to SSH is logged and recorded in
+        the local state as boot_to_ssh. Exits if the Envy has no IP.
+        """
+        if self._ssh_ready:
+            return
         try:
-            image = self.cloud_api.find_image(self.config.image)
-        except novaclient.exceptions.NoUniqueMatch:
-            msg = ('There are more than one images named %s. Please specify '
-                   'image id in your config.')
-            raise SystemExit(msg % self.config.image)
-        if not image:
-            raise SystemExit('The image %s does not exist.' %
-                             self.config.image)
-        flavor = self.cloud_api.find_flavor(self.config.flavor)
-        if not flavor:
-            raise SystemExit('The flavor %s does not exist.' %
-                             self.config.flavor)
-        build_kwargs = {
-            'name': self.name,
-            'image': image,
-            'flavor': flavor,
-        }
+            self.connection().wait_for_ssh(timeout=self.config.ssh_timeout)
+        except exceptions.WaitError as exc:
+            raise SystemExit(str(exc))
+        self._ssh_ready = True
+
+        if self._booted_at is not None:
+            boot_to_ssh = time.time() - self._booted_at
+            logging.info('Envy \'%s\' accepted SSH %.1fs after boot.',
+                         self.name, boot_to_ssh)
+            self.state.record(self.name, boot_to_ssh=round(boot_to_ssh, 2))
+            self._booted_at = None
+
+    def create_server(self, userdata=None, image=None):
+        """Look up the boot resources and trigger creation of the server.
+
+        userdata, if given, is passed to the server (see cloudenvy.userdata).
+        image, if given, is booted instead of the configured image (see
+        cloudenvy.imagecache). This does not wait for the server to become
+        active; see build_server for that.
+
+        The lookups (and creation of the security group, its rules and the
+        keypair, if they are missing) don't depend on each other, so they
+        run concurrently, and every one that fails is reported.
+        """
+        graph = cloudenvy.tasks.Graph()
+        if image is not None:
+            logging.info("Using cached image: %s" % image.name)
+        else:
+            logging.info("Using image: %s" % self.config.image)
+            graph.add('image', self._find_image)
+        graph.add('flavor', self._find_flavor)
 
         logging.info('Using security group: %s', self.config.sec_group_name)
-        self._ensure_sec_group_exists(self.config.sec_group_name)
-        build_kwargs['security_groups'] = [self.config.sec_group_name]
+        self._add_sec_group_tasks(graph, self.config.sec_group_name)
 
         if self.config.keypair_name is not None:
             logging.info('Using keypair: %s', self.config.keypair_name)
-            self._ensure_keypair_exists(self.config.keypair_name,
-                                        self.config.keypair_location)
+            graph.add('keypair', lambda: self._ensure_keypair_exists(
+                self.config.keypair_name, self.config.keypair_location))
+
+        results = graph.run()
+        graph.log_timings(results, 'Preparing to boot')
+        cloudenvy.tasks.check(results)
+
+        build_kwargs = {
+            'name': self.name,
+            'image': image or results['image'].value,
+            'flavor': results['flavor'].value,
+            'security_groups': [self.config.sec_group_name],
+        }
+        if self.config.keypair_name is not None:
             build_kwargs['key_name'] = self.config.keypair_name
 
-        #TODO(jakedahn): Reintroduce this as a 'cloudconfigdrive' config flag.
-        # if self.project_config['userdata_path']:
-        #     userdata_path = self.project_config['userdata_path']
-        #     logging.info('Using userdata from: %s', userdata_path)
-        #     build_kwargs['user_data'] = userdata_path
+        if userdata:
+            build_kwargs['userdata'] = userdata
         if self.config.network_id:
             logging.info('Adding network-id configuration.')
             build_kwargs['nics'] = [{'net-id': self.config.network_id,},]
 
         logging.info('Creating server...')
         server = self.cloud_api.create_server(**build_kwargs)
+        self.state.record(self.name, id=server.id)
+        return server
 
-        server_id = server.id
+    def waiter(self):
+        return cloudenvy.waiter.Waiter(self.cloud_api,
+                                       timeout=self.config.wait_timeout)
 
-        def server_ready(server):
-            return self.cloud_api.is_server_active(server.id)
+    def build_server(self, userdata=None, image=None):
+        self._booted_at = time.time()
+        server = self.create_server(userdata, image)
+        waiter = self.waiter()
 
-        def network_ready(server):
-            return self.cloud_api.is_network_active(server.id)
+        waiter.wait([server.id], self.cloud_api.is_server_active,
+                    'Server was not ready in time',
+                    failed=self.cloud_api.is_server_failed)
 
-        def wait_for_condition(condition_func, fail_msg):
-            for i in xrange(60):
-                _server = self.cloud_api.get_server(server_id)
-                if condition_func(_server):
-                    return True
-                else:
-                    time.sleep(1)
-            else:
-                raise exceptions.Error(fail_msg)
+        self.cloud_api.setup_network(server.id)
 
-        wait_for_condition(server_ready, 'Server was not ready in time')
+        servers = waiter.wait([server.id], self.cloud_api.is_network_active,
+                              'Network was not ready in time')
+        self._server = servers[server.id]
 
-        self.cloud_api.setup_network(server_id)
+    def _find_image(self):
+        image = self.cloud_api.find_image(self.config.image)
+        if not image:
+            raise SystemExit('The image %s does not exist.' %
+                             self.config.image)
+        return image
 
-        wait_for_condition(network_ready, 'Network was not ready in time')
+    def _find_flavor(self):
+        flavor = self.cloud_api.find_flavor(self.config.flavor)
+        if not flavor:
+            raise SystemExit('The flavor %s does not exist.' %
+                             self.config.flavor)
+        return flavor
 
-    def _ensure_sec_group_exists(self, name):
+    def _sec_group_rules(self):
+        if 'sec_groups' in self.config.project_config:
+            return [tuple(rule.split(', ')) for rule in
+                    self.config.project_config['sec_groups']]
+        return [tuple(rule.split(', ')) for rule in
+                self.config.default_config['sec_groups']]
+
+    def _add_sec_group_tasks(self, graph, name):
+        """Add tasks that make sure the security group and its rules exist.
+
+        Each rule is created by a task of its own once the group exists.
+        """
+        rules = self._sec_group_rules()
+        graph.add('security_group',
+                  lambda: self._ensure_sec_group_exists(name, rules))
+
+        def _add_rule(rule):
+            def _task(group):
+                sec_group, needs_rules = group
+                if needs_rules:
+                    logging.debug('... adding rule: %s', rule)
+                    logging.info('Creating Security Group Rule %s'
+                                 % str(rule))
+                    self.cloud_api.create_security_group_rule(sec_group,
+                                                              rule)
+                return needs_rules
+            return _task
+
+        rule_tasks = []
+        for index, rule in enumerate(rules):
+            rule_tasks.append('security_group_rule_%d' % index)
+            graph.add(rule_tasks[-1], _add_rule(rule),
+                      requires=['security_group'])
+
+        def _record(*created):
+            if any(created):
+                self.cloud_api.catalog.set('security_group_rules', name,
+                                           map(list, rules))
+                logging.info('...done.')
+
+        graph.add('security_group_rules', _record, requires=rule_tasks)
+
+    def _ensure_sec_group_exists(self, name, rules):
+        """Return the security group and whether its rules need creating."""
         sec_group = self.cloud_api.find_security_group(name)
+        created = not sec_group
 
         if not sec_group:
-            try:
-                sec_group = self.cloud_api.create_security_group(name)
-            except novaclient.exceptions.BadRequest:
-                logging.error('Security Group "%s" already exists.' % name)
-
-        if 'sec_groups' in self.config.project_config:
-            rules = [tuple(rule.split(', ')) for rule in
-                     self.config.project_config['sec_groups']]
-        else:
-            rules = [tuple(rule.split(', ')) for rule in
-                     self.config.default_config['sec_groups']]
-        for rule in rules:
-            logging.debug('... adding rule: %s', rule)
-            logging.info('Creating Security Group Rule %s' % str(rule))
-            self.cloud_api.create_security_group_rule(sec_group, rule)
+            sec_group = self.cloud_api.create_security_group(name)
 
-        logging.info('...done.')
+        # The rules only ever need to be created once per group, so skip the
+        # round trips if the catalog says this exact set already went in.
+        catalog = self.cloud_api.catalog
+        if not created and \
+                catalog.get('security_group_rules', name) == map(list, rules):
+            logging.debug('Security Group Rules for %s are cached.', name)
+            return sec_group, False
+        return sec_group, True
 
     def _ensure_keypair_exists(self, name, pubkey_location):
         if not self.cloud_api.find_keypair(name):
@@ -154,7 +319,22 @@ class Envy(object):
             print name
 
 
+REQUIRES_NOTHING = 'nothing'
+REQUIRES_CONFIG = 'config'
+REQUIRES_CLOUD = 'cloud'
+
+
 class Command(object):
+    """Base class for envy commands.
+
+    requires declares what the command needs initialized before it runs:
+    REQUIRES_NOTHING commands get no config at all, REQUIRES_CONFIG
+    commands get the parsed config files but no cloud API (asking for one
+    is an error), and REQUIRES_CLOUD commands may also use the cloud API,
+    which is still only constructed (and authenticated) when first used.
+    """
+
+    requires = REQUIRES_CLOUD
 
     def __init__(self, argparser, commands):
         self.commands = commands
@@ -163,5 +343,14 @@ class Command(object):
     def _build_subparser(self, subparser):
         return subparser
 
-    def run(self, config, args):
+    def requirements(self, args):
+        return self.requires
+
+    def run(self, config, args, envy=None):
+        """Run the command.
+
+        Commands that are chained from other commands accept the caller's
+        Envy so that the cloud client, the server and its IP are only
+        resolved once per invocation.
+        """
         return
@@ -27,3 +27,17 @@ class NoIPsAvailable(Error):
 
 class UserConfigNotPresent(Error):
     pass
+
+
+class WaitError(Error):
+    """Raised when servers fail or time out while being waited on."""
+
+    def __init__(self, message, ready=None, pending=None, failed=None):
+        super(WaitError, self).__init__(message)
+        self.ready = ready or {}
+        self.pending = pending or set()
+        self.failed = failed or {}
+
+
+class TransferError(Error):
+    pass
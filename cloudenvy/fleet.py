@@ -0,0 +1,160 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import collections
+import logging
+import multiprocessing.pool
+import time
+
+from cloudenvy import exceptions
+import cloudenvy.core
+import cloudenvy.pool
+import cloudenvy.waiter
+
+
+DEFAULT_PARALLELISM = 10
+
+
+Result = collections.namedtuple('Result', ['name', 'value', 'error',
+                                           'elapsed'])
+
+
+def run_concurrently(func, names, parallelism=DEFAULT_PARALLELISM):
+    """Call func(name) for every name through a bounded thread pool.
+
+    Returns a list of Result tuples in the same order as names. Errors
+    (including SystemExit, which the core raises for user-facing failures)
+    are captured per name rather than aborting the whole batch.
+    """
+    names = list(names)
+    if not names:
+        return []
+
+    def _wrapped(name):
+        start = time.time()
+        try:
+            value = func(name)
+        except (Exception, SystemExit) as exc:
+            logging.debug('%s failed: %s', name, exc, exc_info=True)
+            return Result(name, None, exc, time.time() - start)
+        return Result(name, value, None, time.time() - start)
+
+    pool = multiprocessing.pool.ThreadPool(min(parallelism, len(names)))
+    try:
+        return pool.map(_wrapped, names)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def select(envy, prefix=None):
+    """Return the servers of envy's project.
+
+    With a prefix, only those whose name starts with <base name>-<prefix>
+    are returned. Standbys of the pool (see cloudenvy.pool) never are.
+    """
+    base_name = envy.config.base_name
+    servers = [server for server in envy.list_servers()
+               if not cloudenvy.pool.is_standby(envy.config, server.name)]
+    if prefix is None:
+        return [server for server in servers
+                if server.name == base_name
+                or server.name.startswith('%s-' % base_name)]
+    prefix = '%s-%s' % (base_name, prefix)
+    return [server for server in servers
+            if server.name.startswith(prefix)]
+
+
+def fleet_names(base_name, count):
+    return ['%s-%d' % (base_name, i) for i in xrange(1, count + 1)]
+
+
+def boot(config, names, parallelism=DEFAULT_PARALLELISM, userdata=None):
+    """Boot one Envy per name concurrently.
+
+    Envys that are already running are left alone; new ones are given
+    userdata, if any. The create and network setup calls go through the
+    worker pool, while the readiness waits of the whole fleet are batched
+    into a single Waiter, so each poll costs one API call no matter how
+    many Envys are booting.
+    """
+    start = time.time()
+    #NOTE: every Envy of config shares one cloud API. Building its client
+    # here, rather than in the first worker to need it, means a password
+    # prompt happens once, in the main thread.
+    cloud_api = cloudenvy.core.cloud_api(config)
+    cloud_api.client
+    envys = dict((name, cloudenvy.core.Envy(config, name=name))
+                 for name in names)
+    status = {}
+    ready_at = {}
+    errors = {}
+
+    def _create(name):
+        envy = envys[name]
+        if envy.server():
+            status[name] = 'running'
+            return envy.server().id
+        status[name] = 'created'
+        return envy.create_server(userdata).id
+
+    # Only new servers are waited on and get their network set up; doing
+    # that again for a running one would give it another floating IP.
+    server_ids = {}
+    for result in run_concurrently(_create, names, parallelism):
+        if result.error is not None:
+            errors[result.name] = result.error
+        elif status[result.name] == 'running':
+            ready_at[result.name] = start + result.elapsed
+        else:
+            server_ids[result.value] = result.name
+
+    waiter = cloudenvy.waiter.Waiter(cloud_api,
+                                     timeout=config.wait_timeout)
+
+    def _wait(condition, fail_msg, failed=None):
+        try:
+            waiter.wait(server_ids.keys(), condition, fail_msg, failed)
+        except exceptions.WaitError as exc:
+            for server_id in list(exc.pending) + exc.failed.keys():
+                errors[server_ids.pop(server_id)] = exc
+
+    _wait(cloud_api.is_server_active, 'Server was not ready in time',
+          failed=cloud_api.is_server_failed)
+
+    def _setup_network(server_id):
+        envys[server_ids[server_id]].cloud_api.setup_network(server_id)
+
+    for result in run_concurrently(_setup_network, server_ids.keys(),
+                                   parallelism):
+        if result.error is not None:
+            errors[server_ids.pop(result.name)] = result.error
+
+    def _network_ready(server):
+        if not cloud_api.is_network_active(server):
+            return False
+        ready_at.setdefault(server_ids[server.id], time.time())
+        return True
+
+    _wait(_network_ready, 'Network was not ready in time')
+
+    def _ip(name):
+        if name in errors:
+            raise errors[name]
+        return status[name], envys[name].ip()
+
+    # Report how long each Envy took to become reachable rather than how
+    # long the final IP lookup took.
+    return [result._replace(elapsed=ready_at.get(result.name, time.time())
+                            - start)
+            for result in run_concurrently(_ip, names, parallelism)]
+
+
+def print_table(headers, rows):
+    """Print rows as left-aligned columns under the given headers."""
+    rows = [[str(cell) for cell in row] for row in rows]
+    widths = [max([len(header)] + [len(row[i]) for row in rows])
+              for i, header in enumerate(headers)]
+    row_format = '  '.join(['%%-%ds' % width for width in widths])
+
+    print (row_format % tuple(headers)).rstrip()
+    for row in rows:
+        print (row_format % tuple(row)).rstrip()
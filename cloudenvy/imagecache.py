@@ -0,0 +1,132 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import hashlib
+import logging
+import os
+import time
+
+import cloudenvy.provisioning
+import cloudenvy.sync
+
+
+# Image metadata (tags on EC2) that marks an image as a cached, already
+# provisioned Envy.
+KEY_TAG = 'cloudenvy_cache_key'
+PROJECT_TAG = 'cloudenvy_project'
+LAST_USED_TAG = 'cloudenvy_last_used'
+
+DEFAULT_QUOTA = 3
+
+
+def cache_key(envy, files=True, scripts=None):
+    """Hash everything that goes into a freshly provisioned Envy.
+
+    That is the base image, the remote user, the content and targets of the
+    Envyfile's files (if files) and the provision scripts (a find_scripts
+    list, if given) together with the provision inputs. Two Envys with the
+    same key come out of `envy up` the same, so one can boot from a
+    snapshot of the other.
+    """
+    config = envy.config
+    image = envy.cloud_api.find_image(config.image)
+    if not image:
+        raise SystemExit('The image %s does not exist.' % config.image)
+
+    digest = hashlib.sha256()
+    digest.update('image\0%s\nuser\0%s\n' % (image.id, config.remote_user))
+
+    if files:
+        mappings = [(os.path.expanduser(local), remote) for local, remote
+                    in config.project_config.get('files', {}).items()]
+        entries, dirs = cloudenvy.sync.walk(sorted(mappings), set())
+        for entry in entries:
+            digest.update('file\0%s\0%o\0%s\n' % (
+                entry.remote_path, entry.mode,
+                cloudenvy.sync.file_hash(entry.local_path)))
+
+    if scripts is not None:
+        inputs = config.project_config.get('provision_inputs', [])
+        hashes = cloudenvy.provisioning.chain(scripts, inputs)
+        digest.update('provision\0%s\n' % (
+            hashes[-1] if hashes
+            else cloudenvy.provisioning.inputs_hash(inputs)))
+
+    return digest.hexdigest()
+
+
+def _matching(cloud_api, key):
+    return [image for image in cloud_api.list_snapshots(KEY_TAG)
+            if image.metadata.get(KEY_TAG) == key]
+
+
+def _last_used(image):
+    try:
+        return int(image.metadata.get(LAST_USED_TAG, 0))
+    except ValueError:
+        return 0
+
+
+def lookup(cloud_api, key):
+    """Return the ready cached image for key, or None.
+
+    A hit is marked as used, which keeps it from being evicted.
+    """
+    images = _matching(cloud_api, key)
+    ready = sorted([image for image in images if image.status == 'ready'],
+                   key=_last_used, reverse=True)
+    if not ready:
+        if any(image.status == 'pending' for image in images):
+            logging.info('A cached image for this Envy is still being '
+                         'saved; booting from the base image.')
+        return None
+
+    image = ready[0]
+    try:
+        cloud_api.update_snapshot(image.id,
+                                  {LAST_USED_TAG: str(int(time.time()))})
+    except Exception as exc:
+        logging.warning('Unable to mark cached image %s as used: %s',
+                        image.name, exc)
+    return image
+
+
+def store(envy, key):
+    """Snapshot a freshly provisioned Envy as the cached image for key.
+
+    The snapshot is only requested, not waited for; it can be used once
+    the cloud reports it ready. Nothing is done if an image for key is
+    already there or on its way.
+    """
+    if [image for image in _matching(envy.cloud_api, key)
+            if image.status != 'failed']:
+        return None
+
+    project = envy.config.base_name
+    name = '%s-cache-%s' % (project, key[:12])
+    logging.info('Saving Envy \'%s\' as cached image %s.', envy.name, name)
+    return envy.cloud_api.snapshot(envy.server(), name, {
+        KEY_TAG: key,
+        PROJECT_TAG: project,
+        LAST_USED_TAG: str(int(time.time())),
+    })
+
+
+def evict(cloud_api, project, quota=DEFAULT_QUOTA):
+    """Delete the project's cached images beyond the quota.
+
+    The least recently used go first, and failed images always go.
+    """
+    images = [image for image in cloud_api.list_snapshots(KEY_TAG)
+              if image.metadata.get(PROJECT_TAG) == project]
+    usable = sorted([image for image in images if image.status != 'failed'],
+                    key=_last_used, reverse=True)
+    doomed = [image for image in images if image.status == 'failed']
+    doomed += usable[max(quota, 0):]
+
+    for image in doomed:
+        logging.info('Evicting cached image %s.', image.name)
+        try:
+            cloud_api.delete_snapshot(image.id)
+        except Exception as exc:
+            logging.warning('Unable to delete cached image %s: %s',
+                            image.name, exc)
+    return doomed
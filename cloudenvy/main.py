@@ -2,37 +2,26 @@
 
 import argparse
 import logging
-import pkgutil
-import string
+import sys
 
 from cloudenvy.config import EnvyConfig,Config
 
 import cloudenvy.commands
+import cloudenvy.core
 
 
-#TODO(bcwaldon): replace this with entry points!
-def _load_commands():
-    """Iterate through modules in command and import suspected command classes
-
-    This looks for a class in each module in cloudenvy.commands that has the
-    same name as its module with the first character uppercased. For example,
-    the cloudenvy.commands.up module should have a class Up within it.
-    """
-    modlist = list(pkgutil.iter_modules(cloudenvy.commands.__path__))
-    #NOTE(bcwaldon): this parses out a string representation of each
-    # individual command module. For example, if we had a single command
-    # in cloudenvy.commands named 'up', this list would look like ['up]
-    commands = [_[1] for _ in modlist]
-    for command in commands:
-        #NOTE(bcwaldon): the __import__ statement returns a handle on the
-        # top-level 'cloudenvy' package, so we must iterate down through
-        # each sub-package to get a handle on our module
-        module_name = 'cloudenvy.commands.{0}'.format(command)
-        _cloudenvy = __import__(module_name, globals(), locals(), [], -1)
-        module = getattr(_cloudenvy.commands, command)
-
-        command_class = getattr(module, string.capitalize(command))
-        yield (command, command_class)
+def _find_command(argv):
+    """Return the name of the subcommand in argv without parsing the rest."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-v', '--verbosity', action='count')
+    parser.add_argument('-c', '--cloud', action='store')
+    parser.add_argument('command', nargs='?')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    try:
+        args, _ = parser.parse_known_args(argv)
+    except SystemExit:
+        return None
+    return args.command
 
 
 def _build_parser():
@@ -45,11 +34,15 @@ def _build_parser():
     return parser
 
 
-def _init_help_command(parser, subparser):
+def _init_help_command(parser, subparser, commands):
 
     def find_command_help(config, args):
-        if args.command:
-            subparser.choices[args.command].print_help()
+        command = args.command and cloudenvy.commands.module_for(args.command)
+        if command:
+            scratch = argparse.ArgumentParser(prog=parser.prog)
+            subparsers = scratch.add_subparsers()
+            commands.load(command, subparsers)
+            subparsers.choices[args.command].print_help()
         else:
             parser.print_help()
 
@@ -65,23 +58,31 @@ def _init_help_command(parser, subparser):
     return parser
 
 
-def _init_commands(commands, parser):
-    _commands = {}
-    for (command, command_class) in commands:
-        _commands[command] = command_class(parser, _commands)
-
-
-def main():
-    parser = _build_parser()
+def _init_commands(parser, argv):
     command_subparser = parser.add_subparsers(title='Available commands')
-    _init_help_command(parser, command_subparser)
+    commands = cloudenvy.commands.Registry(command_subparser)
+    _init_help_command(parser, command_subparser, commands)
+
+    command = cloudenvy.commands.module_for(_find_command(argv))
+    if command:
+        commands.load(command)
+    commands.add_placeholders(exclude=commands.keys())
+    return commands.get(command)
 
-    commands = _load_commands()
-    _init_commands(commands, command_subparser)
 
-    args = parser.parse_args()
-    config = Config(args)
-    config = EnvyConfig(config)
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = _build_parser()
+    command = _init_commands(parser, argv)
+
+    args = parser.parse_args(argv)
+    requires = command and command.requirements(args)
+    if requires in (None, cloudenvy.core.REQUIRES_NOTHING):
+        config = None
+    else:
+        config = Config(args)
+        config = EnvyConfig(config)
+        config.offline = requires == cloudenvy.core.REQUIRES_CONFIG
 
     if args.verbosity == 3:
         logging.getLogger().setLevel(logging.DEBUG)
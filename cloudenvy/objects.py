@@ -0,0 +1,78 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import binascii
+import os
+import pipes
+
+import cloudenvy.ssh
+
+
+#NOTE: Paths are relative to the remote user's home directory, which is
+# where the transfer commands run.
+OBJECTS_DIR = '.cloudenvy/objects'
+
+# Objects no upload has used for this many days are deleted, and so are
+# the leftovers of uploads interrupted more than a day ago.
+MAX_AGE_DAYS = 30
+
+
+def object_path(digest):
+    return '%s/%s' % (OBJECTS_DIR, digest)
+
+
+def incoming_dir():
+    """A fresh directory name for objects that are still being received."""
+    return '%s/.incoming-%s' % (OBJECTS_DIR,
+                                binascii.hexlify(os.urandom(8)))
+
+
+def missing(connection, digests):
+    """Return which of the sha256 digests the Envy's store doesn't have.
+
+    The digests are checked in a single command, fed through its stdin so
+    that there is no limit on how many there are.
+    """
+    digests = sorted(set(digests))
+    if not digests:
+        return set()
+    status, stdout, stderr = connection.exec_command(
+        'mkdir -p %s && cd %s && while read h; do [ -f "$h" ] || echo "$h"; '
+        'done' % (cloudenvy.ssh.quote_path(OBJECTS_DIR),
+                  cloudenvy.ssh.quote_path(OBJECTS_DIR)),
+        stdin='\n'.join(digests) + '\n')
+    if status:
+        return set(digests)
+    return set(stdout.split())
+
+
+def listing_record(digest, mode, target):
+    """One entry of the listing read by materialize_command.
+
+    Records are NUL terminated and the target comes last, so it is taken
+    verbatim whatever characters it holds.
+    """
+    return '%s %o %s\0' % (digest, mode, target)
+
+
+def materialize_command(incoming, listing, use_sudo=False):
+    """Shell command that files away received objects and places targets.
+
+    Objects only enter the store once they have been received completely,
+    so an interrupted upload never leaves a truncated object behind.
+    listing holds a listing_record for each target. Targets are copies
+    rather than hard links, so editing one on the Envy can't corrupt the
+    store. Each object used is marked as accessed, and objects that have
+    gone unused for MAX_AGE_DAYS are pruned.
+    """
+    script = ('I=%s; O=%s; '
+              'for f in "$I"/*; do [ -f "$f" ] && mv -f "$f" "$O"/; done; '
+              'while IFS= read -r -d "" r; do '
+              'h=${r%%%% *}; r=${r#* }; m=${r%%%% *}; t=${r#* }; '
+              'cp -pf "$O/$h" "$t" && chmod "$m" "$t" && touch -a "$O/$h" '
+              '|| exit 1; '
+              'done < "$I"/%s; '
+              'find "$O" -maxdepth 1 -type f -atime +%d -delete; '
+              'find "$O" -maxdepth 1 -name ".incoming-*" -mtime +1 '
+              '-exec rm -rf {} +; true'
+              % (incoming, OBJECTS_DIR, listing, MAX_AGE_DAYS))
+    return '%sbash -c %s && rm -rf %s' % ('sudo ' if use_sudo else '',
+                                          pipes.quote(script), incoming)
@@ -0,0 +1,191 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+
+import cloudenvy.cache
+
+
+# Standby Envys are named <project>-<state>-<key>-<token>: they boot as
+# WARMING and become STANDBY, i.e. claimable, once they are provisioned.
+# While being claimed they are named <Envy name>.claim-<nonce>.
+STANDBY = 'pool'
+WARMING = 'warming'
+
+# How long a claimer waits after renaming a standby before checking that
+# no one else renamed it too.
+CLAIM_SETTLE = 1.0
+
+CLAIM_MARKER = '.claim-'
+
+LOG_NAME = 'pool.log'
+
+
+def _settings(config):
+    return cloudenvy.cache.JsonFile(os.path.join(
+        cloudenvy.cache.cache_dir(config.cloud_name), 'pool.json'))
+
+
+def settings(config):
+    """Return how the project's pool was last filled, or None."""
+    return _settings(config).load().get(config.base_name)
+
+
+def remember(config, size, files, provision):
+    def _remember(data):
+        data[config.base_name] = {
+            'size': size, 'files': files, 'provision': provision}
+    _settings(config).update(_remember)
+
+
+def forget(config):
+    def _forget(data):
+        data.pop(config.base_name, None)
+    _settings(config).update(_forget)
+
+
+@contextlib.contextmanager
+def fill_lock(config):
+    """Hold the project's fill lock; yield whether it could be taken.
+
+    Fills running at the same time would each count the standbys before
+    the other's show up and boot too many, so only one runs per project.
+    The lock goes away with the process holding it.
+    """
+    dirname = cloudenvy.cache.cache_dir(config.cloud_name)
+    try:
+        os.makedirs(dirname, 0700)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+    with open(os.path.join(dirname, 'pool-%s.lock' % config.base_name),
+              'a') as fap:
+        try:
+            fcntl.flock(fap, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+        else:
+            yield True
+
+
+def pool_key(envy, files=True, scripts=None):
+    """Short hash of everything a standby has to match to be claimed."""
+    #NOTE: the image cache pulls in the provisioning and ssh modules (and
+    # with them fabric), which fleet.select, and so `envy destroy`, would
+    # otherwise import just to recognize standby names.
+    import cloudenvy.imagecache
+
+    config = envy.config
+    digest = hashlib.sha256('%s\0%s\0%s\0%s' % (
+        cloudenvy.imagecache.cache_key(envy, files, scripts), config.flavor,
+        config.keypair_name, config.sec_group_name))
+    return digest.hexdigest()[:8]
+
+
+def name_prefix(config, state, key=None):
+    prefix = '%s-%s-' % (config.base_name, state)
+    if key:
+        prefix += '%s-' % key
+    return prefix
+
+
+def is_standby(config, name):
+    """Whether name belongs to a standby, warming or being claimed."""
+    return (name.startswith(name_prefix(config, STANDBY))
+            or name.startswith(name_prefix(config, WARMING))
+            or CLAIM_MARKER in name)
+
+
+def new_name(config, key):
+    return '%s%s' % (name_prefix(config, WARMING, key), uuid.uuid4().hex[:6])
+
+
+def standby_name(config, name):
+    """The name a warming Envy takes once it can be claimed."""
+    return '%s%s' % (name_prefix(config, STANDBY),
+                     name[len(name_prefix(config, WARMING)):])
+
+
+def members(envy, state=STANDBY, key=None):
+    prefix = name_prefix(envy.config, state, key)
+    return [server for server in envy.list_servers()
+            if server.name.startswith(prefix)]
+
+
+def claim(envy, key):
+    """Make a ready standby matching key envy's server; return it or None.
+
+    A standby is claimed by renaming it, first to a name unique to this
+    claim and, once that name is seen to have stuck, to envy's name. This
+    is verify-after-write, not atomic: neither cloud offers a conditional
+    rename, and on EC2, whose tags are eventually consistent, two claims
+    of the same standby racing within CLAIM_SETTLE can both succeed.
+    """
+    cloud_api = envy.cloud_api
+    candidates = [server for server in members(envy, STANDBY, key)
+                  if cloud_api.is_server_active(server)
+                  and cloud_api.is_network_active(server)]
+    # Claimers starting at the same time shouldn't all go for the first one.
+    random.shuffle(candidates)
+
+    claiming = '%s%s%s' % (envy.name, CLAIM_MARKER, uuid.uuid4().hex[:8])
+    for server in candidates:
+        try:
+            cloud_api.rename_server(server, claiming)
+        except Exception as exc:
+            logging.debug('Unable to claim %s: %s', server.name, exc)
+            continue
+        time.sleep(CLAIM_SETTLE)
+        claimed = cloud_api.get_server(server.id)
+        if claimed is None or claimed.name != claiming:
+            logging.debug('Standby %s was claimed by someone else.',
+                          server.name)
+            continue
+
+        cloud_api.rename_server(claimed, envy.name)
+        claimed = cloud_api.get_server(server.id)
+        if claimed is None:
+            continue
+        envy.adopt(claimed)
+        return claimed
+    return None
+
+
+def refill_in_background(config, cloud=None):
+    """Start `envy pool fill` in a detached process to top the pool up.
+
+    Its output goes to pool.log in the cloud's cache directory.
+    """
+    pool = settings(config)
+    if not pool:
+        return None
+
+    command = [sys.executable, '-c',
+               'import cloudenvy.main; cloudenvy.main.main()', '-v']
+    if cloud:
+        command += ['-c', cloud]
+    command += ['pool', 'fill', '--size', str(pool['size'])]
+    if not pool['files']:
+        command.append('--no-files')
+    if not pool['provision']:
+        command.append('--no-provision')
+
+    log_path = os.path.join(cloudenvy.cache.cache_dir(config.cloud_name),
+                            LOG_NAME)
+    logging.info('Refilling the pool in the background; see %s.', log_path)
+    with open(os.devnull) as devnull:
+        with open(log_path, 'a') as log:
+            return subprocess.Popen(command, stdin=devnull, stdout=log,
+                                    stderr=subprocess.STDOUT, close_fds=True,
+                                    preexec_fn=os.setsid)
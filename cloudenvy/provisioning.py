@@ -0,0 +1,155 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import hashlib
+import logging
+import os
+
+import cloudenvy.fleet
+import cloudenvy.ssh
+import cloudenvy.sync
+
+
+# Scripts containing this line are run in a session of their own, e.g.
+# because they reboot the Envy or need to be the only thing running.
+SEPARATE_MARKER = '# cloudenvy: separate'
+
+RESULTS_PATH = '~/.cloudenvy/provision-results'
+
+# Chained hashes of the scripts that have completed, one per line.
+LEDGER_PATH = '~/.cloudenvy/provision-ledger'
+
+
+def wanted(project_config, no_provision=False):
+    """Whether `envy up` should run the Envyfile's provision scripts."""
+    return not no_provision \
+        and (project_config.get("auto_provision", True)
+             and 'provision_scripts' in project_config)
+
+
+def wants_separate(path):
+    with open(path) as fap:
+        return any(line.strip() == SEPARATE_MARKER for line in fap)
+
+
+def inputs_hash(paths):
+    """Hash the names and contents of the files under paths."""
+    digest = hashlib.sha256()
+    for path in sorted(os.path.expanduser(path) for path in paths):
+        if os.path.isdir(path):
+            files = sorted(os.path.join(dirpath, filename)
+                           for dirpath, dirnames, filenames in os.walk(path)
+                           for filename in filenames)
+        elif os.path.isfile(path):
+            files = [path]
+        else:
+            logging.warning("Provision input '%s' not found.", path)
+            digest.update('%s\0missing\n' % path)
+            continue
+        for filename in files:
+            digest.update('%s\0%s\n' % (
+                filename, cloudenvy.sync.file_hash(filename)))
+    return digest.hexdigest()
+
+
+def chain(scripts, inputs):
+    """Return a hash for every script that also covers everything before it.
+
+    A script's hash changes with its content, its remote path, the
+    provision inputs and any earlier script, so a change to one script
+    invalidates it and every script after it.
+    """
+    previous = inputs_hash(inputs)
+    hashes = []
+    for index, local, remote in scripts:
+        previous = hashlib.sha256('%s\0%s\0%s' % (
+            previous, remote, cloudenvy.sync.file_hash(local))).hexdigest()
+        hashes.append(previous)
+    return hashes
+
+
+def batches(scripts):
+    """Group (index, local path, remote path) scripts into sessions.
+
+    Consecutive scripts share a session; a script that asks to run
+    separately gets one to itself.
+    """
+    groups = []
+    batch = []
+    for script in scripts:
+        if wants_separate(script[1]):
+            if batch:
+                groups.append(batch)
+            groups.append([script])
+            batch = []
+        else:
+            batch.append(script)
+    if batch:
+        groups.append(batch)
+    return groups
+
+
+def runner(batch, hashes):
+    """Shell command running a batch of scripts in order, in one session.
+
+    Each script's exit status and run time (in seconds) is appended to
+    RESULTS_PATH, the hash of every script that succeeds to LEDGER_PATH,
+    and the batch stops at the first failure.
+    """
+    steps = ' && '.join(['_run %d %s %s' % (index,
+                                            cloudenvy.ssh.quote_path(remote),
+                                            hashes[index])
+                         for index, local, remote in batch])
+    return ('_run() { start=$(date +%%s); "$2"; status=$?; '
+            'echo "$1 $status $(($(date +%%s) - start))" >> %s; '
+            '[ $status -eq 0 ] && echo "$3" >> %s; '
+            'return $status; }; %s' % (
+                cloudenvy.ssh.quote_path(RESULTS_PATH),
+                cloudenvy.ssh.quote_path(LEDGER_PATH), steps))
+
+
+def find_scripts(project_config, paths=None):
+    """Return (index, local path, remote path) for the scripts to run.
+
+    paths (e.g. from --scripts) take precedence over the Envyfile.
+    """
+    if paths:
+        scripts = [os.path.expanduser(script) for script in paths]
+    elif project_config.get('provision_scripts'):
+        scripts = [os.path.expanduser(script) for script in
+                   project_config['provision_scripts']]
+    elif project_config.get('provision_script_path'):
+        provision_script = project_config['provision_script_path']
+        scripts = [os.path.expanduser(provision_script)]
+    else:
+        raise SystemExit('Please specify the path to your provision '
+                         'script(s) by either using the `--scripts` '
+                         'flag, or by defining the `provision_scripts`'
+                         ' config option in your Envyfile.')
+    return [(index, path, '~/%s' % os.path.basename(path))
+            for index, path in enumerate(scripts)]
+
+
+def report(connection, scripts, start=0):
+    """Log and tabulate the exit status and run time of every script."""
+    status, stdout, stderr = connection.exec_command(
+        'cat %s' % cloudenvy.ssh.quote_path(RESULTS_PATH))
+    results = {}
+    for line in stdout.splitlines():
+        index, code, seconds = line.split()
+        results[int(index)] = (int(code), int(seconds))
+
+    rows = []
+    for index, local, remote in scripts:
+        if index < start:
+            rows.append((local, 'skipped', '-'))
+            continue
+        if index not in results:
+            rows.append((local, 'not run', '-'))
+            continue
+        code, seconds = results[index]
+        if code:
+            logging.error('Provision script \'%s\' failed with exit '
+                          'code %d.', local, code)
+        else:
+            logging.info('Provision script \'%s\' finished.' % local)
+        rows.append((local, code, seconds))
+    cloudenvy.fleet.print_table(('SCRIPT', 'EXIT', 'SECONDS'), rows)
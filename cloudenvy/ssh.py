@@ -0,0 +1,261 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import logging
+import os
+import pipes
+import select
+import socket
+import subprocess
+import threading
+import time
+
+import fabric.api
+import fabric.exceptions
+import fabric.state
+import paramiko
+
+from cloudenvy import exceptions
+import cloudenvy.cache
+import cloudenvy.waiter
+
+
+CONTROL_DIR = os.path.join(cloudenvy.cache.CACHE_DIR, 'ssh')
+
+_lock = threading.Lock()
+
+
+def quote_path(path):
+    """Quote a remote path for the shell, keeping a leading ~ expandable."""
+    if path == '~':
+        return path
+    if path.startswith('~/'):
+        return '~/%s' % pipes.quote(path[2:])
+    return pipes.quote(path)
+
+
+class Connection(object):
+    """One authenticated SSH transport to an Envy.
+
+    The transport is registered in fabric's connection cache, so fabric
+    operations run inside settings() open their channels on it instead of
+    doing a handshake of their own, and the other helpers here open raw
+    channels on the same transport. Connections are shared by everything in
+    the process that talks to the same user@host.
+
+    With control_persist set, `ssh` shell-outs additionally go through an
+    OpenSSH ControlMaster socket that outlives the process, so later
+    invocations can skip the handshake too.
+    """
+
+    def __init__(self, host, user, port=22, forward_agent=True,
+                 control_persist=None, timeout=10, on_failure=None):
+        self.host = host
+        self.user = user
+        self.port = port
+        self.forward_agent = forward_agent
+        self.control_persist = control_persist
+        self.timeout = timeout
+        self.on_failure = on_failure
+
+    @property
+    def host_string(self):
+        return '%s@%s:%s' % (self.user, self.host, self.port)
+
+    def connect(self, notify=True):
+        """Return the shared paramiko client, connecting if needed.
+
+        On failure, on_failure is called (unless notify is false) and
+        NetworkError raised.
+        """
+        with _lock:
+            if self.host_string in fabric.state.connections:
+                client = fabric.state.connections[self.host_string]
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return client
+
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(self.host, port=self.port, username=self.user,
+                           timeout=self.timeout, allow_agent=True,
+                           look_for_keys=True)
+        except (socket.error, paramiko.SSHException) as exc:
+            if self.on_failure and notify:
+                self.on_failure()
+            raise fabric.exceptions.NetworkError(
+                'Unable to connect to %s: %s' % (self.host_string, exc), exc)
+        client.get_transport().set_keepalive(30)
+
+        with _lock:
+            fabric.state.connections[self.host_string] = client
+        return client
+
+    @property
+    def transport(self):
+        return self.connect().get_transport()
+
+    def _port_open(self, timeout):
+        """Whether sshd answers on the port with an SSH banner."""
+        deadline = time.time() + timeout
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        try:
+            sock.connect_ex((self.host, self.port))
+            readable, writable, errored = select.select([], [sock], [sock],
+                                                        timeout)
+            if not writable or sock.getsockopt(socket.SOL_SOCKET,
+                                               socket.SO_ERROR):
+                return False
+            # The banner may arrive in pieces.
+            banner = ''
+            while len(banner) < 4:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                readable, writable, errored = select.select(
+                    [sock], [], [], remaining)
+                if not readable:
+                    return False
+                data = sock.recv(4 - len(banner))
+                if not data:
+                    return False
+                banner += data
+            return banner == 'SSH-'
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+
+    def wait_for_ssh(self, timeout=240, initial_delay=0.25, max_delay=2.0):
+        """Block until the Envy accepts SSH logins; return the time taken.
+
+        The port is polled with cheap non-blocking connects, spaced with
+        a short backoff, until sshd sends its banner. Only then is a full
+        login attempted (and retried the same way, since the key may not
+        be installed yet), which leaves the shared transport connected.
+        """
+        start = time.time()
+        deadline = start + timeout
+        delays = cloudenvy.waiter.backoff(initial_delay, max_delay)
+        while True:
+            if self._port_open(min(2.0, max(deadline - time.time(), 0.1))):
+                try:
+                    self.connect(notify=False)
+                    break
+                except fabric.exceptions.NetworkError as exc:
+                    logging.debug('SSH login failed: %s', exc)
+            delay = next(delays)
+            if time.time() + delay > deadline:
+                if self.on_failure:
+                    self.on_failure()
+                raise exceptions.WaitError(
+                    'SSH on %s was not ready in time' % self.host_string)
+            time.sleep(delay)
+
+        elapsed = time.time() - start
+        logging.debug('SSH on %s ready after %.2fs', self.host_string,
+                      elapsed)
+        return elapsed
+
+    def settings(self, **kwargs):
+        """Fabric settings that route fabric operations to this Envy."""
+        self.connect()
+        kwargs.setdefault('host_string', self.host_string)
+        kwargs.setdefault('forward_agent', self.forward_agent)
+        kwargs.setdefault('disable_known_hosts', True)
+        return fabric.api.settings(**kwargs)
+
+    def exec_command(self, command, stdin=None, bufsize=65536,
+                     on_output=None):
+        """Run command on a new channel and return (status, stdout, stderr).
+
+        stdin may be a string or an iterable of strings, which is streamed
+        to the command as it is produced. Output is drained while input is
+        being sent so that a chatty command can't stall the upload. With
+        on_output, output is passed to on_output(data, is_stderr) as it
+        arrives instead of being collected, and '' is returned for both
+        streams. The local SSH agent is forwarded if forward_agent is set,
+        as it is for fabric operations.
+        """
+        stdout, stderr = [], []
+
+        def _drain():
+            while channel.recv_ready():
+                data = channel.recv(bufsize)
+                if on_output:
+                    on_output(data, False)
+                else:
+                    stdout.append(data)
+            while channel.recv_stderr_ready():
+                data = channel.recv_stderr(bufsize)
+                if on_output:
+                    on_output(data, True)
+                else:
+                    stderr.append(data)
+
+        channel = self.transport.open_session()
+        forward = None
+        try:
+            if self.forward_agent:
+                forward = paramiko.agent.AgentRequestHandler(channel)
+            channel.exec_command(command)
+            if stdin is not None:
+                if isinstance(stdin, basestring):
+                    stdin = [stdin]
+                for chunk in stdin:
+                    channel.sendall(chunk)
+                    _drain()
+                channel.shutdown_write()
+
+            while not channel.exit_status_ready():
+                select.select([channel], [], [], 0.1)
+                _drain()
+            status = channel.recv_exit_status()
+            _drain()
+            return status, ''.join(stdout), ''.join(stderr)
+        finally:
+            if forward is not None:
+                forward.close()
+            channel.close()
+
+    def close(self):
+        with _lock:
+            if self.host_string in fabric.state.connections:
+                fabric.state.connections[self.host_string].close()
+                del fabric.state.connections[self.host_string]
+
+    @property
+    def control_path(self):
+        return os.path.join(CONTROL_DIR, '%r@%h:%p')
+
+    def ssh_options(self):
+        """OpenSSH options equivalent to the settings used here."""
+        options = ['-o', 'UserKnownHostsFile=/dev/null',
+                   '-o', 'StrictHostKeyChecking=no',
+                   '-p', str(self.port)]
+        if self.forward_agent:
+            options += ['-o', 'ForwardAgent=yes']
+        if self.control_persist:
+            if not os.path.isdir(CONTROL_DIR):
+                os.makedirs(CONTROL_DIR, 0700)
+            options += ['-o', 'ControlMaster=auto',
+                        '-o', 'ControlPath=%s' % self.control_path,
+                        '-o', 'ControlPersist=%s' % self.control_persist]
+        return options
+
+    def ssh_command(self, *args):
+        return (['ssh'] + self.ssh_options()
+                + ['%s@%s' % (self.user, self.host)] + list(args))
+
+    def master_alive(self):
+        """Whether a ControlMaster from an earlier invocation is running."""
+        if not self.control_persist:
+            return False
+        command = ['ssh', '-o', 'ControlPath=%s' % self.control_path,
+                   '-O', 'check', '-p', str(self.port),
+                   '%s@%s' % (self.user, self.host)]
+        with open(os.devnull, 'w') as devnull:
+            status = subprocess.call(command, stdout=devnull, stderr=devnull)
+        logging.debug('ControlMaster for %s is %s.', self.host_string,
+                      'alive' if status == 0 else 'not running')
+        return status == 0
@@ -0,0 +1,48 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import logging
+import os
+
+import cloudenvy.cache
+
+
+class State(object):
+    """Local record of the Envys booted from this machine.
+
+    Maps each Envy name to the id of its server (and anything else worth
+    remembering about it) so that commands can fetch the server directly
+    instead of scanning every server in the tenant. Entries are only
+    hints: callers must check that the server they point at still exists.
+    """
+
+    def __init__(self, cloud_name):
+        self.cloud_name = cloud_name
+        self.store = cloudenvy.cache.JsonFile(os.path.join(
+            cloudenvy.cache.cache_dir(cloud_name), 'state.json'))
+
+    def get(self, name):
+        return self.store.load().get(name)
+
+    def names(self):
+        return sorted(self.store.load().keys())
+
+    def record(self, name, **fields):
+        def _record(data):
+            entry = data.setdefault(name, {'cloud': self.cloud_name})
+            entry.update(fields)
+        self._update(_record)
+
+    def forget(self, name, *fields):
+        """Drop the given fields of an entry, or the whole entry if none."""
+        def _forget(data):
+            if not fields:
+                data.pop(name, None)
+            else:
+                for field in fields:
+                    data.get(name, {}).pop(field, None)
+        self._update(_forget)
+
+    def _update(self, func):
+        try:
+            self.store.update(func)
+        except (IOError, OSError) as exc:
+            logging.debug('Unable to write local state: %s', exc)
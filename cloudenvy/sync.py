@@ -0,0 +1,151 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import collections
+import hashlib
+import json
+import logging
+import os
+import posixpath
+
+import cloudenvy.ssh
+
+
+MANIFEST_PATH = '~/.cloudenvy/files.json'
+
+_SEPARATOR = '--cloudenvy-manifest--'
+
+Entry = collections.namedtuple('Entry', ['local_path', 'remote_path', 'size',
+                                         'mtime', 'mode'])
+
+
+# sha256 of local files by (path, size, mtime), so a file is only read
+# once per run however many steps look at its content.
+_hashes = {}
+
+
+def file_hash(path, blocksize=1024 * 1024):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fap:
+            for block in iter(lambda: fap.read(blocksize), ''):
+                digest.update(block)
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+
+def _entry(local_path, remote_path):
+    stat = os.stat(local_path)
+    return Entry(local_path, remote_path, stat.st_size, int(stat.st_mtime),
+                 stat.st_mode & 07777)
+
+
+def walk(mappings, remote_dirs):
+    """Expand (local path, remote path) mappings into individual files.
+
+    Targets are resolved the way fabric's put resolves them: a file goes
+    into its remote path, or into it under the same basename if that path
+    is a directory (as listed in remote_dirs) or ends in a slash, and a
+    directory is copied recursively into remote/<basename>/.
+
+    Returns the file entries and every remote directory that has to exist.
+    """
+    entries = []
+    dirs = set()
+    for local_path, remote_path in mappings:
+        if os.path.isdir(local_path):
+            local_root = local_path.rstrip('/')
+            remote_root = posixpath.join(remote_path,
+                                         os.path.basename(local_root))
+            for dirpath, dirnames, filenames in os.walk(local_root):
+                relpath = os.path.relpath(dirpath, local_root)
+                remote_dir = posixpath.normpath(
+                    posixpath.join(remote_root, relpath))
+                dirs.add(remote_dir)
+                for filename in sorted(filenames):
+                    entries.append(_entry(
+                        os.path.join(dirpath, filename),
+                        posixpath.join(remote_dir, filename)))
+        elif os.path.isfile(local_path):
+            if remote_path in remote_dirs or remote_path.endswith('/'):
+                remote_path = posixpath.join(remote_path,
+                                             os.path.basename(local_path))
+            if '/' in remote_path:
+                dirs.add(posixpath.dirname(remote_path))
+            entries.append(_entry(local_path, remote_path))
+        else:
+            logging.error("Local file '%s' not found.", local_path)
+    return entries, dirs
+
+
+def _dir_checks(remote_paths):
+    return ''.join(['[ -d %s ] && echo %d; '
+                    % (cloudenvy.ssh.quote_path(path), index)
+                    for index, path in enumerate(remote_paths)])
+
+
+def _dirs(remote_paths, output):
+    return set(remote_paths[int(index)] for index in output.split())
+
+
+def remote_dirs(connection, remote_paths):
+    """Return which remote_paths are directories on the Envy."""
+    status, stdout, stderr = connection.exec_command(
+        '%strue' % _dir_checks(remote_paths))
+    return _dirs(remote_paths, stdout)
+
+
+def remote_state(connection, remote_paths):
+    """Fetch the manifest and which remote_paths are directories.
+
+    This costs a single command on the Envy.
+    """
+    command = ('%secho %s; cat %s 2>/dev/null; true' % (
+        _dir_checks(remote_paths), _SEPARATOR,
+        cloudenvy.ssh.quote_path(MANIFEST_PATH)))
+    status, stdout, stderr = connection.exec_command(command)
+
+    head, _, manifest = stdout.partition('%s\n' % _SEPARATOR)
+    dirs = _dirs(remote_paths, head)
+    try:
+        manifest = json.loads(manifest) if manifest.strip() else {}
+    except ValueError:
+        logging.warning('Ignoring unreadable manifest on the Envy.')
+        manifest = {}
+    return dirs, manifest
+
+
+def changed(entries, manifest):
+    """Return the entries whose content differs from the manifest.
+
+    Unchanged size and mtime are trusted without reading the file; if only
+    the mtime moved, the content hash decides. Returns the changed entries
+    and the manifest describing the local tree.
+    """
+    updated = {}
+    changes = []
+    for entry in entries:
+        known = manifest.get(entry.remote_path)
+        record = {'size': entry.size, 'mtime': entry.mtime,
+                  'mode': entry.mode}
+        if known and known.get('size') == entry.size \
+                and known.get('mtime') == entry.mtime \
+                and known.get('mode') == entry.mode:
+            record['sha256'] = known.get('sha256')
+        else:
+            record['sha256'] = file_hash(entry.local_path)
+            if not known or known.get('sha256') != record['sha256'] \
+                    or known.get('mode') != entry.mode:
+                changes.append(entry)
+        updated[entry.remote_path] = record
+    return changes, updated
+
+
+def save_manifest(connection, manifest):
+    status, stdout, stderr = connection.exec_command(
+        'mkdir -p %s && cat > %s'
+        % (cloudenvy.ssh.quote_path(posixpath.dirname(MANIFEST_PATH)),
+           cloudenvy.ssh.quote_path(MANIFEST_PATH)),
+        stdin=json.dumps(manifest))
+    if status:
+        logging.warning('Unable to save the file manifest: %s', stderr)
@@ -0,0 +1,145 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import collections
+import logging
+import multiprocessing.pool
+import Queue
+import time
+
+from cloudenvy import exceptions
+
+
+DEFAULT_PARALLELISM = 4
+
+Result = collections.namedtuple('Result', ['name', 'value', 'error',
+                                           'start', 'end'])
+
+
+class Skipped(exceptions.Error):
+    """A task was not run because a task it requires failed."""
+
+
+class Graph(object):
+    """A set of named tasks, some of which require others to finish first.
+
+    run() starts every task as soon as the tasks it requires are done,
+    through a bounded thread pool, and calls it with their values. A task
+    whose requirement failed is skipped rather than run. Errors (including
+    SystemExit) are captured per task, so every failure is known once run()
+    returns, together with when each task started and ended.
+    """
+
+    def __init__(self, parallelism=DEFAULT_PARALLELISM):
+        self.parallelism = parallelism
+        self.tasks = collections.OrderedDict()
+        self.started = None
+
+    def add(self, name, func, requires=()):
+        for required in requires:
+            if required not in self.tasks:
+                raise ValueError('Task %s requires unknown task %s.'
+                                 % (name, required))
+        self.tasks[name] = (func, tuple(requires))
+
+    @staticmethod
+    def _call(name, func, args):
+        start = time.time()
+        try:
+            value = func(*args)
+        except (Exception, SystemExit) as exc:
+            logging.debug('Task %s failed: %s', name, exc, exc_info=True)
+            return Result(name, None, exc, start, time.time())
+        return Result(name, value, None, start, time.time())
+
+    def run(self):
+        """Run every task; return their Results by name, in order added."""
+        self.started = time.time()
+        waiting = collections.OrderedDict(self.tasks)
+        results = {}
+        finished = Queue.Queue()
+        running = 0
+
+        pool = multiprocessing.pool.ThreadPool(
+            max(min(self.parallelism, len(waiting)), 1))
+        try:
+            while waiting or running:
+                # Skipping a task can unblock (and skip) others, so keep
+                # going until nothing more is ready.
+                progress = True
+                while progress:
+                    progress = False
+                    for name, (func, requires) in waiting.items():
+                        if any(required not in results
+                               for required in requires):
+                            continue
+                        del waiting[name]
+                        progress = True
+                        failed = [required for required in requires
+                                  if results[required].error is not None]
+                        if failed:
+                            now = time.time()
+                            results[name] = Result(name, None, Skipped(
+                                '%s failed' % ', '.join(failed)), now, now)
+                            continue
+                        pool.apply_async(self._call, (
+                            name, func,
+                            [results[required].value
+                             for required in requires]),
+                            callback=finished.put)
+                        running += 1
+
+                if not running:
+                    break
+                #NOTE: a blocking get() without a timeout can't be
+                # interrupted with ^C on Python 2.
+                result = finished.get(True, 86400)
+                results[result.name] = result
+                running -= 1
+        finally:
+            pool.close()
+            pool.join()
+
+        return collections.OrderedDict((name, results[name])
+                                       for name in self.tasks)
+
+    def critical_path(self, results):
+        """Return the chain of tasks that determined when run() finished."""
+        if not results:
+            return []
+        name = max(results, key=lambda name: results[name].end)
+        path = [name]
+        while self.tasks[name][1]:
+            name = max(self.tasks[name][1],
+                       key=lambda name: results[name].end)
+            path.append(name)
+        return path[::-1]
+
+    def log_timings(self, results, what='Tasks'):
+        """Log when each task ran and the critical path through them."""
+        for name, result in results.iteritems():
+            logging.debug('  %-24s %6.3fs - %6.3fs  %s', name,
+                          result.start - self.started,
+                          result.end - self.started,
+                          'ok' if result.error is None else 'failed')
+        path = self.critical_path(results)
+        logging.info('%s took %.2fs; critical path: %s', what,
+                     max([result.end for result in results.values()]
+                         + [self.started]) - self.started,
+                     ' -> '.join(['%s (%.2fs)' % (
+                         name, results[name].end - results[name].start)
+                         for name in path]) or 'none')
+
+
+def check(results):
+    """Raise the errors of failed tasks, all of them in one message.
+
+    A single failure is raised as is; tasks that were only skipped because
+    of another failure aren't reported.
+    """
+    errors = [(name, result.error) for name, result in results.iteritems()
+              if result.error is not None
+              and not isinstance(result.error, Skipped)]
+    if len(errors) == 1:
+        raise errors[0][1]
+    if errors:
+        raise SystemExit('\n'.join(['%s: %s' % (name, error)
+                                    for name, error in errors]))
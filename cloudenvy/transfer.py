@@ -0,0 +1,356 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import logging
+import os
+import pipes
+import tarfile
+import time
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from cloudenvy import exceptions
+import cloudenvy.objects
+import cloudenvy.ssh
+import cloudenvy.sync
+
+
+BLOCKSIZE = 64 * 1024
+
+DEFAULT_LEVEL = 6
+
+# Transfers smaller than this are dominated by latency, so `auto` doesn't
+# bother probing the link or compressing them.
+AUTO_MIN_BYTES = 1024 * 1024
+
+PROBE_BYTES = 512 * 1024
+SAMPLE_BYTES = 512 * 1024
+
+# (throughput in bytes per second, codecs it can decode) per Envy, as
+# measured by probe().
+_links = {}
+
+
+def _gzip(level):
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+
+class _Lz4(object):
+    """lz4.frame compressor with the compress()/flush() of zlib's."""
+
+    def __init__(self, level):
+        self._compressor = lz4.frame.LZ4FrameCompressor(
+            compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, ''
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+
+def _zstd(level):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+# Compressor factories (taking a level) and the remote command that undoes
+# them, by codec name. lz4 and zstd are only offered when their Python
+# bindings are installed.
+CODECS = {
+    'gzip': (_gzip, 'gzip -dc'),
+}
+if lz4 is not None:
+    CODECS['lz4'] = (_Lz4, 'lz4 -dc')
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd, 'zstd -dc')
+
+COMPRESS_CHOICES = ['auto', 'none', 'gzip', 'lz4', 'zstd']
+
+# Levels tried by `auto` for each codec, fastest first.
+AUTO_LEVELS = {
+    'gzip': [1, 6],
+    'lz4': [0],
+    'zstd': [1, 3, 9],
+}
+
+
+class Stats(object):
+    """Byte and file counters for one transfer.
+
+    bytes counts the content of the files sent, sent what actually went
+    over the wire (archive headers included, after compression).
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.sent = 0
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return max(time.time() - self.start, 1e-6)
+
+    def log(self, what='Uploaded'):
+        logging.info('%s %d file(s), %d bytes (%d sent) in %.2fs '
+                     '(%.0f bytes/s, %.1f files/s)', what, self.files,
+                     self.bytes, self.sent, self.elapsed,
+                     self.bytes / self.elapsed, self.files / self.elapsed)
+
+
+def archive_name(remote_path):
+    """Name of a remote path inside an archive extracted from ~."""
+    if remote_path == '~':
+        return '.'
+    if remote_path.startswith('~/'):
+        return remote_path[2:]
+    return remote_path
+
+
+def _padding(size):
+    padding = size % tarfile.BLOCKSIZE
+    if padding:
+        return tarfile.NUL * (tarfile.BLOCKSIZE - padding)
+    return ''
+
+
+def tar_stream(members, owner=None, stats=None, blocksize=BLOCKSIZE,
+               extra=()):
+    """Generate a tar archive of (local path, archive name) members.
+
+    The archive is produced block by block, so memory use does not depend
+    on the size of the files. Directories are added without their
+    contents. Local modes and mtimes are kept; owner, if given, is
+    recorded as the owning user and group name. extra is a list of
+    (archive name, data) pairs added as private files after the members.
+    """
+    for local_path, name in members:
+        stat = os.stat(local_path)
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mode = stat.st_mode & 07777
+        tarinfo.mtime = int(stat.st_mtime)
+        if owner:
+            tarinfo.uname = tarinfo.gname = owner
+        if os.path.isdir(local_path):
+            tarinfo.type = tarfile.DIRTYPE
+        else:
+            tarinfo.size = stat.st_size
+        yield tarinfo.tobuf(format=tarfile.GNU_FORMAT)
+
+        if tarinfo.isreg():
+            remaining = tarinfo.size
+            with open(local_path, 'rb') as fap:
+                while remaining > 0:
+                    block = fap.read(min(blocksize, remaining))
+                    if not block:
+                        raise IOError("'%s' shrank while being archived"
+                                      % local_path)
+                    remaining -= len(block)
+                    yield block
+            yield _padding(tarinfo.size)
+
+        if stats is not None:
+            stats.files += 1
+            stats.bytes += tarinfo.size
+
+    for name, data in extra:
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mode = 0600
+        tarinfo.mtime = int(time.time())
+        tarinfo.size = len(data)
+        if owner:
+            tarinfo.uname = tarinfo.gname = owner
+        yield tarinfo.tobuf(format=tarfile.GNU_FORMAT)
+        yield data + _padding(len(data))
+
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+def compress_stream(chunks, codec, level=DEFAULT_LEVEL):
+    """Compress a stream of chunks with the named codec as it goes."""
+    compressor = CODECS[codec][0](level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _counted(chunks, stats):
+    for chunk in chunks:
+        stats.sent += len(chunk)
+        yield chunk
+
+
+def _sample(paths, sample_bytes=SAMPLE_BYTES):
+    """Read up to sample_bytes spread over the first blocks of paths."""
+    per_file = max(sample_bytes // max(len(paths), 1), 4096)
+    sample = []
+    size = 0
+    for path in paths:
+        if size >= sample_bytes:
+            break
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as fap:
+            block = fap.read(min(per_file, sample_bytes - size))
+        sample.append(block)
+        size += len(block)
+    return ''.join(sample)
+
+
+def probe(connection, probe_bytes=PROBE_BYTES):
+    """Measure the link to an Envy and list the codecs it can decode.
+
+    Both come from a single command that swallows a block of random
+    (incompressible) data. The result is remembered per host for the rest
+    of the process.
+    """
+    if connection.host_string in _links:
+        return _links[connection.host_string]
+
+    payload = os.urandom(probe_bytes)
+    start = time.time()
+    status, stdout, stderr = connection.exec_command(
+        'for c in gzip lz4 zstd; do command -v $c >/dev/null && echo $c; '
+        'done; cat > /dev/null', stdin=payload)
+    elapsed = max(time.time() - start, 1e-6)
+
+    link = _links[connection.host_string] = (probe_bytes / elapsed,
+                                             set(stdout.split()))
+    logging.debug('Link to %s: %.0f bytes/s, remote codecs: %s',
+                  connection.host_string, link[0], ', '.join(sorted(link[1])))
+    return link
+
+
+def choose(connection, paths):
+    """Pick the (codec, level) that should move paths the fastest.
+
+    Every candidate is timed on a sample of the data, and the one whose
+    compression time plus transfer time of its output beats sending the
+    data as is wins. Returns (None, None) for no compression.
+    """
+    total = sum(os.path.getsize(path) for path in paths
+                if os.path.isfile(path))
+    if total < AUTO_MIN_BYTES:
+        return None, None
+
+    sample = _sample(paths)
+    throughput, remote_codecs = probe(connection)
+    if not sample:
+        return None, None
+
+    best = (len(sample) / throughput, None, None)
+    for codec in sorted(set(CODECS) & remote_codecs):
+        for level in AUTO_LEVELS[codec]:
+            start = time.time()
+            compressed = ''.join(compress_stream([sample], codec, level))
+            cost = time.time() - start + len(compressed) / throughput
+            logging.debug('%s level %d: ratio %.2f, %.3fs per sample',
+                          codec, level,
+                          float(len(compressed)) / len(sample), cost)
+            if cost < best[0]:
+                best = (cost, codec, level)
+
+    logging.info('Compression for %d bytes at %.0f bytes/s: %s', total,
+                 throughput, '%s level %d' % best[1:] if best[1] else 'none')
+    return best[1:]
+
+
+def resolve(connection, paths, compress, level=DEFAULT_LEVEL):
+    """Turn a --compress choice into the (codec, level) to use.
+
+    A codec that can't be used on either end falls back to gzip, or to
+    no compression if the Envy can't decode gzip either.
+    """
+    if not compress or compress == 'none':
+        return None, None
+    if compress == 'auto':
+        return choose(connection, paths)
+    if compress not in CODECS:
+        logging.warning('%s compression is not available here; '
+                        'falling back to gzip.', compress)
+        compress = 'gzip'
+    remote_codecs = probe(connection)[1]
+    if compress not in remote_codecs:
+        fallback = 'gzip' if 'gzip' in remote_codecs else None
+        logging.warning('%s is not installed on the Envy; %s.', compress,
+                        'falling back to gzip' if fallback
+                        else 'not compressing')
+        if fallback is None:
+            return None, None
+        compress = fallback
+    return compress, level
+
+
+def upload(connection, files, dirs=(), use_sudo=False, compress=None,
+           level=DEFAULT_LEVEL, then=None):
+    """Upload (local path, remote path) pairs over a single channel.
+
+    File contents go into the Envy's content-addressed store (see
+    cloudenvy.objects) and targets are copied out of it, so content the
+    Envy already has, from this or any earlier upload, is not sent again
+    and identical files in one upload are sent once. Whatever is missing
+    is streamed as one tar archive into `tar -x`, so the whole set costs
+    two round trips: one to ask for the missing content and one to send
+    it. Missing parent directories are created as part of the same
+    command, as the remote user (and as root by tar for anything deeper
+    when use_sudo is set). The archive is compressed as chosen by
+    compress (a codec name, `none` or `auto`, see resolve()), and the
+    shell command then, if given, runs on the Envy after the targets are
+    in place.
+    """
+    digests = dict((local_path, cloudenvy.sync.file_hash(local_path))
+                   for local_path, _ in files)
+    missing = cloudenvy.objects.missing(connection, digests.values())
+    sources = dict((digest, local_path)
+                   for local_path, digest in digests.iteritems()
+                   if digest in missing)
+    logging.debug('%d of %d file(s) are already on the Envy.',
+                  len(files) - len(sources), len(files))
+
+    compress, level = resolve(connection, sources.values(), compress, level)
+
+    stats = Stats()
+    incoming = cloudenvy.objects.incoming_dir()
+    members = [(local_path, '%s/%s' % (incoming, digest))
+               for digest, local_path in sorted(sources.iteritems())]
+    listing = ''.join([cloudenvy.objects.listing_record(
+        digests[local_path], os.stat(local_path).st_mode & 07777,
+        archive_name(remote_path)) for local_path, remote_path in files])
+
+    stream = tar_stream(members, owner=connection.user, stats=stats,
+                        extra=[('%s/.list' % incoming, listing)])
+    command = '%star -xpPf -' % ('sudo ' if use_sudo else '')
+    if compress:
+        stream = compress_stream(stream, compress, level)
+        #NOTE: without pipefail a failing decompressor only shows up as
+        # tar complaining about a truncated archive.
+        command = 'bash -c %s' % pipes.quote('set -o pipefail; %s | %s' % (
+            CODECS[compress][1], command))
+    command = 'cd ~ && %s && %s' % (
+        command, cloudenvy.objects.materialize_command(incoming, '.list',
+                                                       use_sudo))
+    command = 'mkdir -p %s && %s' % (
+        ' '.join([cloudenvy.ssh.quote_path(path)
+                  for path in sorted(dirs) + [incoming]]), command)
+    if then:
+        command = '%s && %s' % (command, then)
+
+    status, stdout, stderr = connection.exec_command(
+        command, stdin=_counted(stream, stats))
+    if status:
+        raise exceptions.TransferError(
+            'Upload failed with status %s: %s' % (status, stderr.strip()))
+
+    stats.log()
+    return stats
@@ -0,0 +1,138 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import base64
+import email.mime.multipart
+import email.mime.text
+import json
+import logging
+import pipes
+import time
+
+import cloudenvy.provisioning
+import cloudenvy.ssh
+import cloudenvy.sync
+import cloudenvy.transfer
+import cloudenvy.waiter
+
+
+#NOTE: EC2 accepts at most 16 KB of user data and nova's limit is higher,
+# so payloads are held to EC2's limit for both.
+MAX_SIZE = 16 * 1024
+
+# Written (with the exit status of the scripts) once boot-time provisioning
+# is over.
+MARKER_PATH = '~/.cloudenvy/boot-provision'
+
+DEFAULT_TIMEOUT = 1800
+
+SCRIPT = """#!/bin/sh
+# Provisioning for %(name)s, generated by cloudenvy.
+U=%(user)s
+H=$(getent passwd "$U" | cut -d: -f6)
+as_user() { su -s /bin/sh "$U" -c "$1"; }
+cd "$H" || exit 1
+as_user %(mkdir)s
+base64 -d <<'CLOUDENVY_ARCHIVE' | tar -xzpPf -
+%(archive)s
+CLOUDENVY_ARCHIVE
+%(chmod)s
+as_user %(run)s
+status=$?
+as_user "echo $status > %(marker)s"
+exit $status
+"""
+
+
+def _dirs(files):
+    """The remote directories targets are resolved against at boot.
+
+    Nothing exists on the Envy yet, so only the home directory and
+    targets ending in a slash count as directories.
+    """
+    return set(['~'] + [remote for local, remote in files
+                        if remote.endswith('/')])
+
+
+def build(config, files=True, scripts=None):
+    """Build cloud-init user data that provisions an Envy while it boots.
+
+    The payload is a gzipped multipart message holding one shell script,
+    which unpacks the Envyfile's files (if files) and the provision
+    scripts (a find_scripts list, if given) into the remote user's home
+    directory and runs the scripts as that user, keeping the same results,
+    ledger and file manifest as provisioning over SSH. Returns None if
+    there is nothing to do or the payload would exceed MAX_SIZE, in which
+    case the Envy should be provisioned over SSH instead.
+    """
+    scripts = scripts or []
+    mappings = config.project_config.get('files', {}).items() if files else []
+    if not mappings and not scripts:
+        return None
+
+    entries, dirs = cloudenvy.sync.walk(mappings, _dirs(mappings))
+    changes, manifest = cloudenvy.sync.changed(entries, {})
+    members = [(entry.local_path, entry.remote_path) for entry in entries]
+    members += [(local, remote) for index, local, remote in scripts]
+
+    hashes = cloudenvy.provisioning.chain(
+        scripts, config.project_config.get('provision_inputs', []))
+    extra = [('.cloudenvy/provision-results', ''),
+             ('.cloudenvy/provision-ledger', '')]
+    if mappings:
+        extra.append(('.cloudenvy/files.json', json.dumps(manifest)))
+
+    archive = ''.join(cloudenvy.transfer.compress_stream(
+        cloudenvy.transfer.tar_stream(
+            [(local, cloudenvy.transfer.archive_name(remote))
+             for local, remote in members],
+            owner=config.remote_user, extra=extra), 'gzip', 9))
+
+    if scripts:
+        run = 'cd ~ && %s' % cloudenvy.provisioning.runner(scripts, hashes)
+        chmod = 'chmod 755 %s' % ' '.join(
+            [pipes.quote(cloudenvy.transfer.archive_name(remote))
+             for index, local, remote in scripts])
+    else:
+        run, chmod = 'true', ''
+    script = SCRIPT % {
+        'name': pipes.quote(config.project_config['name']),
+        'user': pipes.quote(config.remote_user),
+        'mkdir': pipes.quote('mkdir -p .cloudenvy %s' % ' '.join(
+            [pipes.quote(cloudenvy.transfer.archive_name(path))
+             for path in sorted(dirs - set(['~']))])),
+        'archive': base64.encodestring(archive).strip(),
+        'chmod': chmod,
+        'run': pipes.quote(run),
+        'marker': MARKER_PATH,
+    }
+
+    message = email.mime.multipart.MIMEMultipart()
+    part = email.mime.text.MIMEText(script, 'x-shellscript')
+    part.add_header('Content-Disposition', 'attachment',
+                    filename='cloudenvy-provision.sh')
+    message.attach(part)
+    payload = ''.join(cloudenvy.transfer.compress_stream(
+        [message.as_string()], 'gzip', 9))
+
+    if len(payload) > MAX_SIZE:
+        logging.warning('Files and provision scripts take %d bytes as user '
+                        'data, more than the %d allowed; provisioning over '
+                        'SSH instead.', len(payload), MAX_SIZE)
+        return None
+    logging.info('Provisioning during boot with %d bytes of user data.',
+                 len(payload))
+    return payload
+
+
+def wait(connection, timeout=DEFAULT_TIMEOUT):
+    """Wait for boot-time provisioning to finish; return its exit status."""
+    deadline = time.time() + timeout
+    delays = cloudenvy.waiter.backoff(1.0, 10.0)
+    while True:
+        status, stdout, stderr = connection.exec_command(
+            'cat %s 2>/dev/null; true' % cloudenvy.ssh.quote_path(MARKER_PATH))
+        if stdout.strip().isdigit():
+            return int(stdout)
+        delay = next(delays)
+        if time.time() + delay > deadline:
+            raise SystemExit('Boot-time provisioning did not finish in time.')
+        time.sleep(delay)
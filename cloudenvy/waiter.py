@@ -0,0 +1,84 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import logging
+import random
+import time
+
+from cloudenvy import exceptions
+
+
+DEFAULT_TIMEOUT = 120
+
+
+def backoff(initial_delay, max_delay, factor=2.0, jitter=0.25):
+    """Generate exponentially growing delays, capped and with jitter."""
+    delay = initial_delay
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * factor, max_delay)
+
+
+class Waiter(object):
+    """Wait for a set of servers to reach a condition.
+
+    Every tick fetches all servers being waited on with a single
+    `get_servers` call and hands the fetched objects straight to the
+    condition functions, so the cost of a tick does not grow with the
+    number of servers. Ticks are spaced with exponential backoff plus
+    jitter, capped at max_delay, until the deadline passes.
+    """
+
+    def __init__(self, cloud_api, timeout=DEFAULT_TIMEOUT, initial_delay=1.0,
+                 max_delay=10.0, backoff=2.0, jitter=0.25):
+        self.cloud_api = cloud_api
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+
+    def _delays(self):
+        return backoff(self.initial_delay, self.max_delay, self.backoff,
+                       self.jitter)
+
+    def wait(self, server_ids, condition, fail_msg='Servers were not ready '
+             'in time', failed=None):
+        """Poll until condition(server) is true for every id in server_ids.
+
+        condition and failed are called with the fetched server object, or
+        None if the cloud did not return the server. Servers for which
+        failed(server) is true stop being polled. Returns a dict mapping
+        server id to the last fetched server object. Raises WaitError if
+        any server failed or the deadline passed before all were ready.
+        """
+        pending = set(server_ids)
+        ready = {}
+        failures = {}
+        deadline = time.time() + self.timeout
+        delays = self._delays()
+
+        while pending:
+            servers = self.cloud_api.get_servers(pending)
+            for server_id in list(pending):
+                server = servers.get(server_id)
+                if condition(server):
+                    ready[server_id] = server
+                    pending.discard(server_id)
+                elif failed is not None and failed(server):
+                    failures[server_id] = server
+                    pending.discard(server_id)
+
+            if not pending:
+                break
+
+            delay = next(delays)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            logging.debug('Waiting on %d server(s), next check in %.1fs.',
+                          len(pending), min(delay, remaining))
+            time.sleep(min(delay, remaining))
+
+        if pending or failures:
+            raise exceptions.WaitError(fail_msg, ready=ready,
+                                       pending=pending, failed=failures)
+        return ready
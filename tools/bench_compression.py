@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Compare upload compression modes on synthetic trees over SSH.
+
+Each tree is uploaded with every available mode through the same transfer
+code `envy files`, `envy scp` and `envy dotfiles` use, into a scratch
+directory on the target host (by default an sshd on localhost, reached with
+your agent or default keys). The target's object store is emptied before
+each upload, so every mode sends the whole tree; the wall clock time, the
+bytes that went over the wire and the effective throughput are reported.
+
+    python tools/bench_compression.py
+    python tools/bench_compression.py --host 10.0.0.5 --user ubuntu -s 64
+"""
+import argparse
+import getpass
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cloudenvy.objects
+import cloudenvy.ssh
+import cloudenvy.transfer
+
+
+WORDS = ('the quick brown fox jumps over the lazy dog def return import '
+         'class self none true false for while if else elif').split()
+
+
+def _text(size):
+    words = []
+    length = 0
+    while length < size:
+        word = random.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+
+TREES = {
+    'text': _text,
+    'random': os.urandom,
+    'mixed': lambda size: (_text(size // 2) + os.urandom(size - size // 2)),
+}
+
+
+def make_tree(root, kind, total_mb, files=64):
+    size = total_mb * 1024 * 1024 // files
+    paths = []
+    for index in xrange(files):
+        path = os.path.join(root, kind, 'dir%d' % (index % 8),
+                            'file%d' % index)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fap:
+            fap.write(TREES[kind](size))
+        paths.append(path)
+    return paths
+
+
+def clean(connection, remote_root):
+    #NOTE: uploads skip content already in the object store, so it has to
+    # go too, or every mode after the first would have nothing to send.
+    connection.exec_command('rm -rf %s %s' % (
+        remote_root, cloudenvy.ssh.quote_path(cloudenvy.objects.OBJECTS_DIR)))
+
+
+def bench(connection, paths, local_root, remote_root, compress):
+    files = [(path, os.path.join(remote_root,
+                                 os.path.relpath(path, local_root)))
+             for path in paths]
+    dirs = set(os.path.dirname(remote) for _, remote in files)
+    clean(connection, remote_root)
+    cloudenvy.transfer._links.clear()
+    start = time.time()
+    stats = cloudenvy.transfer.upload(connection, files, dirs,
+                                      compress=compress)
+    elapsed = time.time() - start
+    clean(connection, remote_root)
+    return elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default=getpass.getuser())
+    parser.add_argument('--port', type=int, default=22)
+    parser.add_argument('-s', '--size', type=int, default=32,
+                        help='Size of each tree in MB.')
+    args = parser.parse_args()
+
+    connection = cloudenvy.ssh.Connection(args.host, args.user,
+                                          port=args.port)
+    modes = (['none'] + sorted(cloudenvy.transfer.CODECS) + ['auto'])
+    local_root = tempfile.mkdtemp(prefix='cloudenvy-bench-')
+    try:
+        for kind in sorted(TREES):
+            paths = make_tree(local_root, kind, args.size)
+            print '%s tree, %d MB' % (kind, args.size)
+            for mode in modes:
+                remote_root = '/tmp/cloudenvy-bench-%d' % os.getpid()
+                elapsed, stats = bench(connection, paths, local_root,
+                                       remote_root, mode)
+                print '  %-6s %7.2fs  %8.1f MB sent  %8.1f MB/s' % (
+                    mode, elapsed, stats.sent / 1024.0 / 1024,
+                    stats.bytes / elapsed / 1024 / 1024)
+    finally:
+        shutil.rmtree(local_root)
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
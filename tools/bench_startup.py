@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Measure how long `envy` takes to get from process start to a command.
+
+Each sample runs a fresh interpreter that imports cloudenvy.main and builds
+the command line for the given arguments, the way `envy` does before it
+dispatches, and reports which heavy dependencies that dragged in.
+
+    python tools/bench_startup.py -n 20 ip
+    python tools/bench_startup.py up -n foo
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+HEAVY_MODULES = ('boto', 'fabric', 'novaclient', 'paramiko', 'pkg_resources')
+
+SNIPPET = """
+import json, sys
+import cloudenvy.main
+parser = cloudenvy.main._build_parser()
+cloudenvy.main._init_commands(parser, sys.argv[1:])
+heavy = sorted(set(name.split('.')[0] for name in sys.modules
+                   if name.split('.')[0] in %r))
+print json.dumps(heavy)
+""" % (HEAVY_MODULES,)
+
+
+def sample(argv):
+    start = time.time()
+    output = subprocess.check_output([sys.executable, '-c', SNIPPET] + argv,
+                                     cwd=os.path.dirname(os.path.dirname(
+                                         os.path.abspath(__file__))))
+    return time.time() - start, json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--samples', type=int, default=10)
+    parser.add_argument('argv', nargs=argparse.REMAINDER,
+                        help='Arguments to pass to envy.')
+    args = parser.parse_args()
+
+    timings = []
+    for _ in xrange(args.samples):
+        elapsed, heavy = sample(args.argv)
+        timings.append(elapsed)
+    timings.sort()
+
+    print 'envy %s' % ' '.join(args.argv)
+    print '  min %.3fs  median %.3fs  max %.3fs over %d runs' % (
+        timings[0], timings[len(timings) // 2], timings[-1], len(timings))
+    print '  heavy modules imported: %s' % (', '.join(heavy) or 'none')
+
+
+if __name__ == '__main__':
+    main()